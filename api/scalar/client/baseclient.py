@@ -1,14 +1,20 @@
 import scalar.protocol.encryption as encryption
+import scalar.protocol.compression as compression
 import scalar.protocol.packets.protocol as protocol
 import scalar.protocol.socket.protosocket as protosocket
+import scalar.protocol.socket.multiplex as multiplex
 import scalar.exceptions as exceptions
 import scalar.primitives as primitives
+import scalar.timerwheel as timerwheel
+import scalar.metrics as metrics
+import scalar.transfer as transfer
 
 import typing
 import asyncio
 import traceback
 import random
 import queue
+import time
 
 VERSION = 1
 
@@ -21,9 +27,39 @@ class BaseClient:
     _server_implementation: str|None = None
     _user: primitives.User|None = None
     _running: bool = False
+    _max_frame_size: int = protosocket.MAX_FRAME_SIZE
+    _multiplexed: bool = False
+    _connect_timeout: float|None = protosocket.CONNECT_TIMEOUT
+    _max_decompressed_size: int = protosocket.MAX_DECOMPRESSED_SIZE
+    _max_decompression_ratio: float = protosocket.MAX_DECOMPRESSION_RATIO
+    _compressions: list[str] = protosocket.COMPRESSIONS
+    _compression_threshold: int = protosocket.COMPRESSION_THRESHOLD
+    _compression_window_bits: int = protosocket.STREAM_WINDOW_BITS
+    _compression_mem_level: int = protosocket.STREAM_MEM_LEVEL
+    _dictionaries: list[str] = list(compression.DICTIONARIES)
+    _coalesce_window: float|None = None
+    _coalesce_budget: int = protosocket.COALESCE_BUDGET
+    _heartbeat_interval: float = 10
+    _heartbeat_misses: int = 5
+    _heartbeat: timerwheel.Timer|None = None
+    _heartbeats_missed: int = 0
+    _last_seen: float = 0
+    _timed_out: bool = False
+    _probe_task: asyncio.Task|None = None
+    _heartbeat_meter: metrics.RateMeter|None = None
+    _transfers: transfer.Transfers|None = None
+    _transfer_partials: dict|None = None
+    _transfer_tasks: set[asyncio.Task]|None = None
+    _closing_tasks: set[asyncio.Task]|None = None
+    _packet_stream: typing.AsyncIterator|None = None
 
     def __init__(self, *, username: str|None = None):
         self._original_username = username
+        # kept across reconnects so the server can resume what it was sending us
+        self._transfer_partials = {}
+        self._transfer_tasks = set()
+        self._closing_tasks = set()
+        self._heartbeat_meter = metrics.RateMeter()
 
         @self.event("on_exception")
         def print_exception(self, e):
@@ -39,6 +75,27 @@ class BaseClient:
     def has_username(self) -> bool:
         return self._original_username is not None
 
+    def set_connect_timeout(self, timeout: float|None):
+        self._connect_timeout = timeout
+
+    def set_heartbeat(self, interval: float|None = None, misses: int|None = None):
+        if interval is not None:
+            if interval <= 0:
+                raise ValueError(f"heartbeat interval must be positive, got {interval}")
+            self._heartbeat_interval = interval
+        if misses is not None:
+            self._heartbeat_misses = misses
+
+    def set_coalescing(self, window: float|None, budget: int = protosocket.COALESCE_BUDGET):
+        self._coalesce_window = window
+        self._coalesce_budget = budget
+
+    def metrics(self) -> dict[str, float]:
+        return {
+            "heartbeats_sent": self._heartbeat_meter.total(),
+            "heartbeat_rate": self._heartbeat_meter.rate(),
+        }
+
     _keys: dict[str, typing.Any] = {}
     def load_key(self, key_type: str, key_bytes: bytes):
         try:
@@ -90,7 +147,7 @@ class BaseClient:
     def connected(self) -> bool:
         return self._socket is not None
 
-    async def connect(self, host: str, port: int):
+    async def connect(self, host: str|None = None, port: int = 0, *, multiplexed: bool = False, via: typing.Optional["BaseClient"] = None):
         if not self.has_username():
             raise exceptions.ClientNoNameSpecified()
         
@@ -98,30 +155,91 @@ class BaseClient:
         
         self._username = self._original_username
 
-        self._socket = protosocket.ProtoSocket(
-            host=host,
-            port=port,
-            encryption=encryption.BaseEncryption # aka no encryption
-        )
-        self._socket.connect()
-        self._socket._socket.settimeout(10)
-        if not await self._protocol_connect():
-            raise exceptions.ClientConnectionError()
+        if via is not None:
+            self._attach(via)
+        else:
+            self._multiplexed = multiplexed
+            self._socket = protosocket.ProtoSocket(
+                host=host,
+                port=port,
+                encryption=encryption.BaseEncryption # aka no encryption
+            )
+            self._socket.set_max_frame_size(self._max_frame_size)
+            self._socket.set_decompression_limits(self._max_decompressed_size, self._max_decompression_ratio)
+            self._socket.set_compression(self._compressions, self._compression_threshold, self._compression_window_bits, self._compression_mem_level)
+            self._socket.set_dictionaries(self._dictionaries)
+            await self._socket.connect(self._connect_timeout)
+            self._socket.settimeout(10)
+            if not await self._protocol_connect():
+                raise exceptions.ClientConnectionError()
+            if protosocket.EXTENSION_MUX in self._socket.extensions:
+                # this session becomes stream 0, others may attach to the connection later
+                mux = multiplex.Multiplexer(self._socket)
+                mux.fingerprint = self._fingerprint
+                sock, self._socket = self._socket, mux.open_stream()
+                sock.setreadtimeout(None)
+                mux.start()
+        self._socket.set_coalescing(self._coalesce_window, self._coalesce_budget)
         if not await self._protocol_login():
             raise exceptions.ClientConnectionError()
         self._user = primitives.User(self._username, self._fingerprint)
+        self._packet_stream = None
+        self._transfers = transfer.Transfers(protocol.packet.SERVER, self._send_packet, self._transfer_received, self._transfer_partials)
         await self._invoke_event('on_login_complete')
+        # liveness is tracked by the heartbeat timer from here on, reads may idle forever
+        self._socket.setreadtimeout(None)
+        self._timed_out = False
+        self._heartbeats_missed = 0
+        self._last_seen = time.monotonic()
+        self._arm_heartbeat(self._heartbeat_interval)
+
+    def _attach(self, via: "BaseClient"):
+        # a new session over an already encrypted connection, no handshake of its own
+        if not isinstance(via._socket, multiplex.StreamSocket):
+            raise exceptions.MultiplexUnavailable()
+        mux = via._socket._mux
+        self._socket = mux.open_stream()
+        self._socket.settimeout(10)
+        self._fingerprint = encryption.fingerprint_stream(mux.fingerprint, self._socket.stream_id)
+
+    async def send_transfer(self, data: bytes, name: str = "", tid: int|None = None) -> int:
+        if self._transfers is None:
+            raise exceptions.TransferAborted("Client is not connected")
+        return await self._transfers.send(data, name, tid)
+
+    async def _transfer_received(self, tid: int, name: str, data: bytes):
+        # the handler may answer with a transfer of its own, whose acknowledgements this reader has to take
+        task = asyncio.create_task(self._invoke_event("on_transfer", tid, name, data))
+        self._transfer_tasks.add(task)
+        task.add_done_callback(self._transfer_tasks.discard)
 
     def close(self):
-        self._socket.close()
-        self._socket = None
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+        if self._transfers is not None:
+            self._transfers.close()
+            self._transfers = None
+        sock, self._socket = self._socket, None
+        if sock.pending():
+            # packets still coalescing go out before the connection does
+            task = asyncio.create_task(sock.aclose())
+            self._closing_tasks.add(task)
+            task.add_done_callback(self._closing_tasks.discard)
+        else:
+            sock.close()
         self._running = False
 
-    def run(self, host: str, port: int):
-        asyncio.run(self.serve(host, port))
+    def run(self, host: str, port: int = 0, *, multiplexed: bool = False):
+        asyncio.run(self.serve(host, port, multiplexed=multiplexed))
+
+    def _offer_extensions(self) -> list[str]:
+        extensions = self._socket.offer_extensions()
+        if self._multiplexed:
+            extensions.append(protosocket.EXTENSION_MUX)
+        return extensions
 
     async def _protocol_connect(self):
-        if await self._socket.send_packet(protocol.SERVERBOUND_HANDSHAKE_Hello(version=VERSION)) != protosocket.SOCKET_SUCCESS:
+        if await self._socket.send_packet(protocol.SERVERBOUND_HANDSHAKE_Hello(version=VERSION, extensions=self._offer_extensions())) != protosocket.SOCKET_SUCCESS:
             return False
         
         stat, packet = await self._socket.recv_packet()
@@ -133,6 +251,7 @@ class BaseClient:
         if type(packet) is not protocol.CLIENTBOUND_HANDSHAKE_Hello:
             self.close()
             raise exceptions.UnexpectedPacket(f"Expected CLIENTBOUND_HANDSHAKE_Hello, got {type(packet).__name__}")
+        self._socket.use_extensions(packet.extensions)
         
         await self._invoke_event("on_hello")
 
@@ -189,14 +308,24 @@ class BaseClient:
             raise exceptions.SocketBroken("Socket closed when sending packet")
         await self._invoke_event("on_packet_sent", packet)
         
+    async def _received(self, packet: protocol.packet.Packet):
+        # any inbound traffic proves the server is alive
+        self._last_seen = time.monotonic()
+        self._heartbeats_missed = 0
+        await self._invoke_event("on_packet_received", packet)
+
     async def _recv_packet(self, expect: protocol.packet.Packet|None = None) -> protocol.packet.Packet:
-        stat, packet = await self._socket.recv_packet()
+        try:
+            stat, packet = await self._socket.recv_packet()
+        except (exceptions.LimitExceeded, exceptions.FrameMalformed):
+            self.close()
+            raise
         if stat == protosocket.SOCKET_TIMEOUT:
             return None
         if stat != protosocket.SOCKET_SUCCESS:
             await self._invoke_event("on_socket_broken")
             raise exceptions.SocketBroken("Socket closed when receiving packet")
-        await self._invoke_event("on_packet_received", packet)
+        await self._received(packet)
         if type(packet) is expect:
             return packet
         if type(packet) is protocol.CLIENTBOUND_Kick:
@@ -217,54 +346,86 @@ class BaseClient:
         self._server_implementation = (await self._recv_packet(protocol.CLIENTBOUND_ImplementationInfo)).implementation
         return True
     
-    async def recv_packets(self):
-        heartbeats_missed = 0
-        queue = []
-        expect_nonce = None
-        while True:
-            packet = await self._recv_packet()
-
-            # send server heartbeat (check server responsiveness)
-            if not packet:
-                expect_nonce = random.randint(0, 65535)
-                await self._send_packet(protocol.SERVERBOUND_SHeartbeat(nonce=expect_nonce))
-                heartbeats_missed += 1
-                if heartbeats_missed > 1:
-                    await self._invoke_event("heartbeat_missed", heartbeats_missed-1)
-            if heartbeats_missed >= 6:
-                self.close()
-                raise exceptions.ConnectionTimedOut()
-            if not packet:
-                continue
-            if type(packet) is protocol.CLIENTBOUND_SHeartbeat:
-                if packet.nonce == expect_nonce:
-                    heartbeats_missed = 0
-                continue
+    def _arm_heartbeat(self, delay: float):
+        self._heartbeat = timerwheel.get_wheel().schedule(delay, self._heartbeat_due)
 
-            # reply to client heartbeat (checking client responsiveness)
-            if type(packet) is protocol.CLIENTBOUND_CHeartbeat:
-                await self._invoke_event("heartbeat", packet.nonce)
-                await self._send_packet(protocol.SERVERBOUND_CHeartbeat(nonce=packet.nonce))
-                continue
+    def _heartbeat_due(self):
+        if self._socket is None:
+            return
+        silence = time.monotonic() - self._last_seen
+        if silence < self._heartbeat_interval:
+            # busy connection, heard from the server recently enough
+            return self._arm_heartbeat(self._heartbeat_interval - silence)
+        self._probe_task = asyncio.create_task(self._send_probe())
 
-            if type(packet) is protocol.CLIENTBOUND_Kick:
-                self.close()
-                raise exceptions.ClientKicked(packet.reason)
-            
-            queue.append(packet)
-            if heartbeats_missed > 0:
-                continue
-            return queue
+    async def _send_probe(self):
+        self._heartbeats_missed += 1
+        if self._heartbeats_missed > self._heartbeat_misses:
+            # wakes the reader, which reports the timeout
+            self._timed_out = True
+            self._socket.close()
+            return
+        self._arm_heartbeat(self._heartbeat_interval)
+        self._heartbeat_meter.add()
+        try:
+            await self._send_packet(protocol.SERVERBOUND_SHeartbeat(nonce=random.randint(0, 65535)))
+        except exceptions.SocketBroken:
+            return
+        if self._heartbeats_missed > 1:
+            await self._invoke_event("heartbeat_missed", self._heartbeats_missed-1)
+
+    async def _heartbeat_packet(self, packet: protocol.packet.Packet) -> bool:
+        # answer to our probe, liveness is already recorded
+        if type(packet) is protocol.CLIENTBOUND_SHeartbeat:
+            return True
+
+        # reply to client heartbeat (checking client responsiveness)
+        if type(packet) is protocol.CLIENTBOUND_CHeartbeat:
+            await self._invoke_event("heartbeat", packet.nonce)
+            await self._send_packet(protocol.SERVERBOUND_CHeartbeat(nonce=packet.nonce))
+            return True
+
+        if type(packet) is protocol.CLIENTBOUND_Kick:
+            self.close()
+            raise exceptions.ClientKicked(packet.reason)
+        return False
+
+    def _lost(self) -> exceptions.ScalarException:
+        if not self._timed_out:
+            return exceptions.SocketBroken("Socket closed when receiving packet")
+        self.close()
+        return exceptions.ConnectionTimedOut()
+
+    async def recv_packets(self):
+        # kept for older callers, it reads through packets() so transfers and heartbeats are still handled
+        if self._packet_stream is None:
+            self._packet_stream = self.packets()
+        return [await anext(self._packet_stream)]
+
+    async def packets(self) -> typing.AsyncIterator[protocol.packet.Packet]:
+        try:
+            async for packet in self._socket.packets():
+                await self._received(packet)
+                if await self._heartbeat_packet(packet):
+                    continue
+                if self._transfers is not None and self._transfers.handles(packet):
+                    await self._transfers.receive(packet)
+                    continue
+                yield packet
+        except (exceptions.LimitExceeded, exceptions.FrameMalformed):
+            self.close()
+            raise
+        except exceptions.SocketBroken as e:
+            await self._invoke_event("on_socket_broken")
+            raise self._lost() from e
         
     async def _process_packet(self, packet_type: type, packet: protocol.packet.Packet):
         pass
 
-    async def serve(self, host: str, port: int):
-        await self.connect(host, port)
-        while True:
-            try:
-                packets = await self.recv_packets()
-            except exceptions.SocketBroken:
-                return
-            for packet in packets:
-                await self._process_packet(type(packet), packet)
\ No newline at end of file
+    async def serve(self, host: str|None = None, port: int = 0, *, multiplexed: bool = False, via: typing.Optional["BaseClient"] = None):
+        await self.connect(host, port, multiplexed=multiplexed, via=via)
+        try:
+            async for packet in self.packets():
+                await self._process_packet(type(packet), packet)
+        except exceptions.SocketBroken:
+            return
\ No newline at end of file
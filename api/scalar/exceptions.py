@@ -23,6 +23,26 @@ class SocketTimedOut(ScalarException):
     Raised when read from socket times out
     """
 
+class LimitExceeded(ScalarException):
+    """
+    Raised when the other side goes past one of our receive limits
+    """
+
+class FrameTooLarge(LimitExceeded):
+    """
+    Raised when a frame is bigger than the maximum frame size or than its length prefix can hold
+    """
+
+class DecompressionLimitExceeded(LimitExceeded):
+    """
+    Raised when a frame inflates past the maximum decompressed size or compression ratio
+    """
+
+class FrameMalformed(ScalarException):
+    """
+    Raised when a frame can't be read: it fails authentication, doesn't inflate, or the packets inside don't add up to the frame
+    """
+
 class ClientConnectionError(ScalarException):
     """
     Raised when Client failed to connect to server
@@ -90,4 +110,19 @@ class ClientThreadSuicideImpossible(ScalarException):
     """
     Raised when client thread tries to end it's own existence
     """
-    
\ No newline at end of file
+class ServerWorkersUnsupported(ScalarException):
+    """
+    Raised when multi-process worker mode is requested on a platform without fork() or SO_REUSEPORT
+    """
+class ClientDisconnected(ScalarException):
+    """
+    Raised inside a server-side client task to unwind it after its connection was closed
+    """
+class MultiplexUnavailable(ScalarException):
+    """
+    Raised when attaching a session to a client whose connection doesn't carry multiplexed sessions
+    """
+class TransferAborted(ScalarException):
+    """
+    Raised to the sender of a bulk transfer that the other side refused or cancelled, or that lost its connection
+    """
@@ -8,16 +8,23 @@ UNIVERSE_MESSAGE = 1
 class Identifier:
     lock = threading.Lock()
     state = {}
+    partition_index = 0
+    partition_count = 1
 
     def __init__(self, state: dict=None):
         if state is not None:
             self.state = state
 
+    def partition(self, index: int, count: int):
+        # server workers hand out interleaved identifiers so they never collide
+        self.partition_index = index
+        self.partition_count = count
+
     def get_identifier(self, universe: int):
         with self.lock:
             if not self.state.get(universe):
                 self.state[universe] = 0
             self.state[universe] += 1
-            identifier = self.state[universe]
+            identifier = self.state[universe] * self.partition_count + self.partition_index
             result = universe + identifier << UNIVERSEBITS
-        return result
+        return result
\ No newline at end of file
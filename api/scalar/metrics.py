@@ -0,0 +1,29 @@
+import time
+
+class RateMeter:
+    """
+    Counts events and reports their rate per second over a sliding window of one-second buckets.
+    """
+    def __init__(self, window: int = 10):
+        self._buckets = [0] * window
+        self._second = int(time.monotonic())
+        self._total = 0
+
+    def _rotate(self):
+        now = int(time.monotonic())
+        elapsed = min(now - self._second, len(self._buckets))
+        for step in range(1, elapsed + 1):
+            self._buckets[(self._second + step) % len(self._buckets)] = 0
+        self._second = now
+
+    def add(self, count: int = 1):
+        self._rotate()
+        self._buckets[self._second % len(self._buckets)] += count
+        self._total += count
+
+    def rate(self) -> float:
+        self._rotate()
+        return sum(self._buckets) / len(self._buckets)
+
+    def total(self) -> int:
+        return self._total
@@ -0,0 +1,23 @@
+import os
+
+DICTIONARY_DIR = os.path.join(os.path.dirname(__file__), "dictionaries")
+DICTIONARY_SUFFIX = ".zdict"
+
+def _version(name: str) -> tuple[str, int]:
+    # scalar0-10 is newer than scalar0-9, which plain string order gets wrong
+    prefix, _, version = name[:-len(DICTIONARY_SUFFIX)].rpartition("-")
+    if not version.isdigit():
+        return name, -1
+    return prefix, int(version)
+
+def load_dictionaries(path: str = DICTIONARY_DIR) -> dict[str, bytes]:
+    # the file name is the version id peers negotiate, newest first
+    dictionaries = {}
+    for name in sorted(os.listdir(path), key=_version, reverse=True):
+        if not name.endswith(DICTIONARY_SUFFIX):
+            continue
+        with open(os.path.join(path, name), "rb") as f:
+            dictionaries[name[:-len(DICTIONARY_SUFFIX)]] = f.read()
+    return dictionaries
+
+DICTIONARIES = load_dictionaries()
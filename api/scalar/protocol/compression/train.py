@@ -0,0 +1,118 @@
+"""
+Trains a zlib preset dictionary from captured packets.
+
+    python -m scalar.protocol.compression.train -o scalar/protocol/compression/dictionaries/scalar0-2.zdict capture.bin ...
+
+Corpus files hold raw packed packets, each behind a 4-byte little endian length, see write_corpus.
+Peers only agree on a dictionary by name, so a retrained one always ships under a new name.
+"""
+import argparse
+import collections
+import random
+import sys
+import zlib
+
+import scalar.primitives as primitives
+import scalar.protocol.packets.protocol as protocol
+
+DICTIONARY_SIZE = 2048
+MIN_MATCH = 4
+MAX_MATCH = 24
+MAX_SAMPLE = 256
+MAX_SAMPLES = 5000
+
+def read_corpus(path: str) -> list[bytes]:
+    samples = []
+    with open(path, "rb") as f:
+        while header := f.read(4):
+            samples.append(f.read(int.from_bytes(header, 'little')))
+    return samples
+
+def write_corpus(path: str, samples: list[bytes]):
+    with open(path, "ab") as f:
+        for sample in samples:
+            f.write(int.to_bytes(len(sample), 4, 'little') + sample)
+
+def train(samples: list[bytes], size: int = DICTIONARY_SIZE) -> bytes:
+    if len(samples) > MAX_SAMPLES:
+        samples = random.sample(samples, MAX_SAMPLES)
+    # how many samples contain each substring, a substring only pays off once per packet anyway
+    counts = collections.Counter()
+    for sample in samples:
+        sample = sample[:MAX_SAMPLE]
+        counts.update({sample[start:start + length]
+                       for length in range(MIN_MATCH, MAX_MATCH + 1)
+                       for start in range(len(sample) - length + 1)})
+    # a back-reference costs about three bytes, everything past that is saved
+    ranked = sorted(((len(chunk) - 3) * count, chunk) for chunk, count in counts.items() if count > 1)
+    chosen = []
+    total = 0
+    while ranked and total < size:
+        _, chunk = ranked.pop()
+        if any(chunk in other for other in chosen):
+            continue
+        chosen.append(chunk)
+        total += len(chunk)
+    # zlib reaches the end of the dictionary with the shortest distances, so the best go last
+    return b"".join(reversed(chosen))[-size:]
+
+def evaluate(dictionary: bytes, samples: list[bytes]) -> tuple[int, int, int]:
+    plain = 0
+    compressed = 0
+    for sample in samples:
+        plain += len(zlib.compress(sample))
+        deflater = zlib.compressobj(wbits=-15, zdict=dictionary)
+        compressed += len(deflater.compress(sample) + deflater.flush())
+    return sum(map(len, samples)), plain, compressed
+
+_WORDS = ["hello", "hi", "hey", "everyone", "anyone", "here", "there", "what", "is", "the", "a", "to", "you",
+          "i", "it", "that", "this", "and", "of", "in", "on", "for", "with", "just", "lol", "ok", "yes", "no",
+          "thanks", "please", "server", "channel", "message", "join", "left", "back", "brb", "gtg", "how", "are",
+          "doing", "good", "nice", "today", "tomorrow", "later", "know", "think", "does", "work", "now", "main"]
+_NAMES = ["alice", "bob", "carol", "dave", "eve", "mallory", "trent", "peggy", "victor", "walter", "user", "guest"]
+
+def synthetic_corpus(count: int, seed: int = 0) -> list[bytes]:
+    """
+    Stand-in for a capture: scalar0 traffic with chat drawn from a small vocabulary.
+    """
+    rng = random.Random(seed)
+    def chat():
+        return " ".join(rng.choice(_WORDS) for _ in range(rng.randint(1, 16)))
+    def name():
+        return rng.choice(_NAMES) + (str(rng.randint(0, 99)) if rng.random() < 0.5 else "")
+    def fingerprint():
+        return rng.getrandbits(64)
+    makers = [
+        (40, lambda: protocol.CLIENTBOUND_UserMessage(mid=rng.randint(0, 100000), channel=rng.randint(0, 8), user=fingerprint(), message=chat())),
+        (20, lambda: protocol.SERVERBOUND_SendMessage(channel=rng.randint(0, 8), message=chat())),
+        (5, lambda: protocol.CLIENTBOUND_ServerMessage(mid=rng.randint(0, 100000), channel=rng.randint(0, 8), message=chat())),
+        (5, lambda: protocol.CLIENTBOUND_EventUserJoined(user=primitives.User(name(), fingerprint()))),
+        (5, lambda: protocol.CLIENTBOUND_EventUserLeft(fingerprint=fingerprint())),
+        (10, lambda: protocol.CLIENTBOUND_SHeartbeat(nonce=rng.randint(0, 65535))),
+        (10, lambda: protocol.SERVERBOUND_CHeartbeat(nonce=rng.randint(0, 65535))),
+        (3, lambda: protocol.CLIENTBOUND_UserListResponse(users={fingerprint(): name() for _ in range(rng.randint(1, 6))})),
+        (2, lambda: protocol.CLIENTBOUND_ChannelListResponse(channels={cid: rng.choice(_WORDS) for cid in range(rng.randint(1, 4))})),
+    ]
+    weights = [weight for weight, _ in makers]
+    return [rng.choices(makers, weights)[0][1]().pack() for _ in range(count)]
+
+def main(argv: list[str]|None = None):
+    parser = argparse.ArgumentParser(description="Train a zlib preset dictionary for Scalar packets")
+    parser.add_argument("corpus", nargs="*", help="corpus files written by write_corpus")
+    parser.add_argument("-o", "--output", required=True)
+    parser.add_argument("-s", "--size", type=int, default=DICTIONARY_SIZE)
+    parser.add_argument("--synthetic", type=int, default=0, help="add this many generated scalar0 packets")
+    args = parser.parse_args(argv)
+    samples = [sample for path in args.corpus for sample in read_corpus(path)]
+    samples += synthetic_corpus(args.synthetic)
+    if not samples:
+        parser.error("no samples, pass corpus files or --synthetic")
+    dictionary = train(samples, args.size)
+    with open(args.output, "wb") as f:
+        f.write(dictionary)
+    small = [sample for sample in samples if len(sample) < 200]
+    raw, plain, compressed = evaluate(dictionary, small)
+    print(f"{len(dictionary)} byte dictionary, packets under 200 bytes: {raw} raw, {plain} zlib, {compressed} with dictionary", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
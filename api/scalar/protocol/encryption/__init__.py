@@ -8,4 +8,10 @@ SUPPORTED = {
 }
 
 def fingerprint_key(key: str) -> int:
-    return int(hashlib.sha256(key.encode()).hexdigest()[0:16], 16)
\ No newline at end of file
+    return int(hashlib.sha256(key.encode()).hexdigest()[0:16], 16)
+
+def fingerprint_stream(fingerprint: int, stream_id: int) -> int:
+    # sessions multiplexed over one connection share its key but must not share an identity
+    if stream_id == 0:
+        return fingerprint
+    return fingerprint_key(f"{fingerprint:016x}#{stream_id}")
@@ -2,6 +2,14 @@ class BaseEncryption:
     def __init__(self):
         pass
 
+    @staticmethod
+    def use_counter_nonces(server: bool, salt: bytes):
+        pass
+
+    @staticmethod
+    def overhead() -> int:
+        return 0
+
     @staticmethod
     def encrypt(data):
         return data
@@ -1,39 +1,78 @@
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 import os
 
 from scalar.protocol.encryption.baseencryption import BaseEncryption
 from scalar.protocol.encryption.dhkeypair import DHKeypair
+import scalar.exceptions
+
+NONCE_SIZE = 12
+TAG_SIZE = 16
+# counter nonces start with the sending side, so the two directions never meet under the shared key
+CLIENT_NONCE_PREFIX = b"\x00\x00\x00\x00"
+SERVER_NONCE_PREFIX = b"\x00\x00\x00\x01"
 
 class DHAESEncryption(BaseEncryption):
     keypair: DHKeypair
+    _aead: AESGCM|None = None
+    _send_prefix: bytes|None = None
+    _recv_prefix: bytes|None = None
+    _send_counter: int = 0
+    _recv_counter: int = 0
 
     def __init__(self, keypair: DHKeypair):
         self.keypair = keypair
 
     def public_key(self):
         return self.keypair.public_key()
-    
+
     def shared_key(self):
         return self.keypair.shared_key
-    
+
     def exchange(self, public_bytes: bytes):
         self.keypair.derive(public_bytes)
+        self._aead = AESGCM(self.shared_key())
+
+    def use_counter_nonces(self, server: bool, salt: bytes):
+        # both ends count the messages of each direction, so the nonce never has to travel.
+        # Counters start over with every connection but the keys don't, the salt makes a fresh key for each one
+        self._aead = AESGCM(HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=salt,
+            info=b'counter nonces',
+        ).derive(self.shared_key()))
+        self._send_prefix = SERVER_NONCE_PREFIX if server else CLIENT_NONCE_PREFIX
+        self._recv_prefix = CLIENT_NONCE_PREFIX if server else SERVER_NONCE_PREFIX
+
+    def overhead(self) -> int:
+        return TAG_SIZE if self._send_prefix is not None else NONCE_SIZE + TAG_SIZE
 
     def encrypt(self, message):
-        iv = os.urandom(12)
-        encryptor = Cipher(
-            algorithms.AES(self.shared_key()),
-            modes.GCM(iv)
-        ).encryptor()
-        encrypted = encryptor.update(message) + encryptor.finalize()
-        return iv+encryptor.tag+encrypted
-    
+        if self._send_prefix is not None:
+            nonce = self._send_prefix + self._send_counter.to_bytes(8, 'little')
+            self._send_counter += 1
+            return self._aead.encrypt(nonce, message, None)
+        # iv, tag, ciphertext for peers that don't count nonces
+        iv = os.urandom(NONCE_SIZE)
+        encrypted = self._aead.encrypt(iv, message, None)
+        return b"".join((iv, encrypted[-TAG_SIZE:], encrypted[:-TAG_SIZE]))
+
     def decrypt(self, message):
-        iv = message[0:12]; message = message[12:]
-        tag = message[0:16]; message = message[16:]
-        decryptor = Cipher(
-            algorithms.AES(self.shared_key()),
-            modes.GCM(iv, tag)
-        ).decryptor()
-        decrypted = decryptor.update(message) + decryptor.finalize()
-        return decrypted
+        try:
+            return self._decrypt(memoryview(message))
+        except InvalidTag:
+            raise scalar.exceptions.FrameMalformed("Frame failed authentication") from None
+
+    def _decrypt(self, message):
+        if self._recv_prefix is not None:
+            nonce = self._recv_prefix + self._recv_counter.to_bytes(8, 'little')
+            decrypted = self._aead.decrypt(nonce, message, None)
+            # only counted once it authenticated, a forged frame doesn't shift the counter
+            self._recv_counter += 1
+            return decrypted
+        iv = message[:NONCE_SIZE]
+        tag = message[NONCE_SIZE:NONCE_SIZE + TAG_SIZE]
+        return self._aead.decrypt(bytes(iv), b"".join((message[NONCE_SIZE + TAG_SIZE:], tag)), None)
@@ -1,2 +1,2 @@
-from scalar.protocol.packets.packet import Packet, register, SERVER, CLIENT
+from scalar.protocol.packets.packet import Packet, register, SERVER, CLIENT, PRIORITY_CONTROL, PRIORITY_INTERACTIVE, PRIORITY_BULK, PRIORITIES
 from scalar.protocol.packets.buffer import Buffer
\ No newline at end of file
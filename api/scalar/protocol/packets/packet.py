@@ -4,6 +4,11 @@ import types
 
 SERVER = 'SERVERBOUND'
 CLIENT = 'CLIENTBOUND'
+# outbound lanes, a lower number always goes out first
+PRIORITY_CONTROL = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_BULK = 2
+PRIORITIES = 3
 registered = {}
 registered[SERVER] = {}
 registered[CLIENT] = {}
@@ -11,8 +16,11 @@ registered[CLIENT] = {}
 class Packet:
 	pid = None
 	side = 'UNBOUND'
+	priority = PRIORITY_INTERACTIVE
 	datavalues = {}
 	defaults = {}
+	_packed = None
+	_wire = None
 
 	def __init__(self, **kwargs):
 		if kwargs.get("__SKIPDATAVALUES", False): 
@@ -36,6 +44,19 @@ class Packet:
 		buffer.seek(0)
 		data = buffer.handle.read(buffer.size())
 		return data
+	def packed(self):
+		# broadcasts hand the same packet to every recipient, it is only serialized once
+		if self._packed is None:
+			self._packed = self.pack()
+		return self._packed
+	def wire(self, key, build):
+		# per-encoding forms of packed(), e.g. compressed, built once for every socket that shares key
+		if self._wire is None:
+			self._wire = {}
+		form = self._wire.get(key)
+		if form is None:
+			form = self._wire[key] = build(self.packed())
+		return form
 	@staticmethod
 	def unpack(side, data):
 		if side not in [SERVER, CLIENT]:
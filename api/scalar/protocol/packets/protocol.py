@@ -2,26 +2,46 @@ import scalar.primitives as primitives
 import scalar.protocol.packets.packet as packet
 
 ### HANDSHAKE STAGE
+def _write_extensions(buffer: packet.buf.Buffer, extensions: list[str]):
+    buffer.WriteU16(len(extensions))
+    for extension in extensions:
+        buffer.WriteStringNT(extension)
+def _read_extensions(buffer: packet.buf.Buffer) -> list[str]:
+    # peers that predate extensions end the packet right after the version
+    if buffer.tell() >= buffer.size():
+        return []
+    extensions = []
+    for i in range(buffer.ReadU16()):
+        extensions.append(buffer.ReadStringNT())
+    return extensions
+
 class SERVERBOUND_HANDSHAKE_Hello(packet.Packet):
     side = packet.SERVER
-    datavalues = {"version": int}
-    defaults = {}
+    priority = packet.PRIORITY_CONTROL
+    datavalues = {"version": int, "extensions": list[str]}
+    defaults = {"extensions": []}
     def _write(self, buffer: packet.buf.Buffer):
         buffer.WriteU16(self.version)
+        _write_extensions(buffer, self.extensions)
     def _read(self, buffer: packet.buf.Buffer):
         self.version = buffer.ReadU16()
+        self.extensions = _read_extensions(buffer)
 
 class CLIENTBOUND_HANDSHAKE_Hello(packet.Packet):
     side = packet.CLIENT
-    datavalues = {"version": int}
-    defaults = {}
+    priority = packet.PRIORITY_CONTROL
+    datavalues = {"version": int, "extensions": list[str]}
+    defaults = {"extensions": []}
     def _write(self, buffer: packet.buf.Buffer):
         buffer.WriteU16(self.version)
+        _write_extensions(buffer, self.extensions)
     def _read(self, buffer: packet.buf.Buffer):
         self.version = buffer.ReadU16()
+        self.extensions = _read_extensions(buffer)
 
 class SERVERBOUND_HANDSHAKE_EncryptionSupported(packet.Packet):
     side = packet.SERVER
+    priority = packet.PRIORITY_CONTROL
     datavalues = {"encryptions": list[str]}
     defaults = {}
     def _write(self, buffer: packet.buf.Buffer):
@@ -35,6 +55,7 @@ class SERVERBOUND_HANDSHAKE_EncryptionSupported(packet.Packet):
             
 class CLIENTBOUND_HANDSHAKE_EncryptionSelect(packet.Packet):
     side = packet.CLIENT
+    priority = packet.PRIORITY_CONTROL
     datavalues = {"select": int}
     defaults = {}
     def _write(self, buffer: packet.buf.Buffer):
@@ -44,6 +65,7 @@ class CLIENTBOUND_HANDSHAKE_EncryptionSelect(packet.Packet):
 
 class SERVERBOUND_HANDSHAKE_EncryptionPubKey(packet.Packet):
     side = packet.SERVER
+    priority = packet.PRIORITY_CONTROL
     datavalues = {"key": str}
     defaults = {}
     def _write(self, buffer: packet.buf.Buffer):
@@ -53,6 +75,7 @@ class SERVERBOUND_HANDSHAKE_EncryptionPubKey(packet.Packet):
 
 class CLIENTBOUND_HANDSHAKE_EncryptionPubKey(packet.Packet):
     side = packet.CLIENT
+    priority = packet.PRIORITY_CONTROL
     datavalues = {"key": str}
     defaults = {}
     def _write(self, buffer: packet.buf.Buffer):
@@ -70,6 +93,7 @@ packet.register(CLIENTBOUND_HANDSHAKE_EncryptionPubKey)
 ### LOGIN STAGE
 class SERVERBOUND_LOGIN_UserInfo(packet.Packet):
     side = packet.SERVER
+    priority = packet.PRIORITY_CONTROL
     datavalues = {"username": str}
     defaults = {}
     def _write(self, buffer: packet.buf.Buffer):
@@ -79,6 +103,7 @@ class SERVERBOUND_LOGIN_UserInfo(packet.Packet):
 
 class CLIENTBOUND_LOGIN_UserInfo(packet.Packet):
     side = packet.CLIENT
+    priority = packet.PRIORITY_CONTROL
     datavalues = {"username": str}
     defaults = {}
     def _write(self, buffer: packet.buf.Buffer):
@@ -92,6 +117,7 @@ packet.register(CLIENTBOUND_LOGIN_UserInfo)
 ### GENERAL
 class CLIENTBOUND_SHeartbeat(packet.Packet):
     side = packet.CLIENT
+    priority = packet.PRIORITY_CONTROL
     datavalues = {"nonce": int}
     defaults = {}
     def _write(self, buffer: packet.buf.Buffer):
@@ -100,6 +126,7 @@ class CLIENTBOUND_SHeartbeat(packet.Packet):
         self.nonce = buffer.ReadU16()
 class SERVERBOUND_SHeartbeat(packet.Packet):
     side = packet.SERVER
+    priority = packet.PRIORITY_CONTROL
     datavalues = {"nonce": int}
     defaults = {}
     def _write(self, buffer: packet.buf.Buffer):
@@ -108,6 +135,7 @@ class SERVERBOUND_SHeartbeat(packet.Packet):
         self.nonce = buffer.ReadU16()
 class CLIENTBOUND_CHeartbeat(packet.Packet):
     side = packet.CLIENT
+    priority = packet.PRIORITY_CONTROL
     datavalues = {"nonce": int}
     defaults = {}
     def _write(self, buffer: packet.buf.Buffer):
@@ -116,6 +144,7 @@ class CLIENTBOUND_CHeartbeat(packet.Packet):
         self.nonce = buffer.ReadU16()
 class SERVERBOUND_CHeartbeat(packet.Packet):
     side = packet.SERVER
+    priority = packet.PRIORITY_CONTROL
     datavalues = {"nonce": int}
     defaults = {}
     def _write(self, buffer: packet.buf.Buffer):
@@ -129,6 +158,7 @@ packet.register(CLIENTBOUND_CHeartbeat)
 
 class CLIENTBOUND_ImplementationInfo(packet.Packet):
     side = packet.CLIENT
+    priority = packet.PRIORITY_CONTROL
     datavalues = {"implementation": str}
     defaults = {}
     def _write(self, buffer: packet.buf.Buffer):
@@ -137,6 +167,7 @@ class CLIENTBOUND_ImplementationInfo(packet.Packet):
         self.implementation = buffer.ReadStringNT()
 class SERVERBOUND_ImplementationInfo(packet.Packet):
     side = packet.SERVER
+    priority = packet.PRIORITY_CONTROL
     datavalues = {"implementation": str}
     defaults = {}
     def _write(self, buffer: packet.buf.Buffer):
@@ -148,6 +179,7 @@ packet.register(CLIENTBOUND_ImplementationInfo)
 
 class CLIENTBOUND_Kick(packet.Packet):
     side = packet.CLIENT
+    priority = packet.PRIORITY_CONTROL
     datavalues = {"reason": str}
     defaults = {"reason": "no reason specified"}
     def _write(self, buffer: packet.buf.Buffer):
@@ -158,6 +190,7 @@ packet.register(CLIENTBOUND_Kick)
 
 class CLIENTBOUND_UserMessage(packet.Packet):
     side = packet.CLIENT
+    priority = packet.PRIORITY_INTERACTIVE
     datavalues = {"mid": int, "channel": int, "user": int, "message": str}
     defaults = {}
     def _write(self, buffer: packet.buf.Buffer):
@@ -172,6 +205,7 @@ class CLIENTBOUND_UserMessage(packet.Packet):
         self.message = buffer.ReadStringNT()
 class SERVERBOUND_SendMessage(packet.Packet):
     side = packet.SERVER
+    priority = packet.PRIORITY_INTERACTIVE
     datavalues = {"channel": int, "message": str}
     defaults = {}
     def _write(self, buffer: packet.buf.Buffer):
@@ -182,6 +216,7 @@ class SERVERBOUND_SendMessage(packet.Packet):
         self.message = buffer.ReadStringNT()
 class CLIENTBOUND_ServerMessage(packet.Packet):
     side = packet.CLIENT
+    priority = packet.PRIORITY_INTERACTIVE
     datavalues = {"mid": int, "channel": int, "message": str}
     defaults = {}
     def _write(self, buffer: packet.buf.Buffer):
@@ -198,14 +233,18 @@ packet.register(CLIENTBOUND_ServerMessage)
 
 class SERVERBOUND_UserListRequest(packet.Packet):
     side = packet.SERVER
+    priority = packet.PRIORITY_INTERACTIVE
     datavalues = {}
     defaults = {}
 class SERVERBOUND_ChannelListRequest(packet.Packet):
     side = packet.SERVER
+    priority = packet.PRIORITY_INTERACTIVE
     datavalues = {}
     defaults = {}
 class CLIENTBOUND_UserListResponse(packet.Packet):
     side = packet.CLIENT
+    # a snapshot must not overtake the join and leave events queued after it
+    priority = packet.PRIORITY_INTERACTIVE
     datavalues = {"users": dict[int,str]}
     defaults = {}
     def _write(self, buffer: packet.buf.Buffer):
@@ -221,6 +260,8 @@ class CLIENTBOUND_UserListResponse(packet.Packet):
             self.users[fingerprint] = name
 class CLIENTBOUND_ChannelListResponse(packet.Packet):
     side = packet.CLIENT
+    # a snapshot must not overtake the join and leave events queued after it
+    priority = packet.PRIORITY_INTERACTIVE
     datavalues = {"channels": dict[int,str]}
     defaults = {}
     def _write(self, buffer: packet.buf.Buffer):
@@ -241,6 +282,7 @@ packet.register(CLIENTBOUND_ChannelListResponse)
 
 class CLIENTBOUND_EventUserJoined(packet.Packet):
     side = packet.CLIENT
+    priority = packet.PRIORITY_INTERACTIVE
     datavalues = {"user": primitives.User}
     defaults = {}
     def _write(self, buffer: packet.buf.Buffer):
@@ -252,6 +294,7 @@ class CLIENTBOUND_EventUserJoined(packet.Packet):
         self.user = primitives.User(username, fingerprint)
 class CLIENTBOUND_EventUserLeft(packet.Packet):
     side = packet.CLIENT
+    priority = packet.PRIORITY_INTERACTIVE
     datavalues = {"fingerprint": int}
     defaults = {}
     def _write(self, buffer: packet.buf.Buffer):
@@ -260,3 +303,74 @@ class CLIENTBOUND_EventUserLeft(packet.Packet):
         self.fingerprint = buffer.ReadU64()
 packet.register(CLIENTBOUND_EventUserJoined)
 packet.register(CLIENTBOUND_EventUserLeft)
+
+### TRANSFERS
+class SERVERBOUND_TransferBegin(packet.Packet):
+    side = packet.SERVER
+    priority = packet.PRIORITY_INTERACTIVE
+    datavalues = {"tid": int, "name": str, "size": int, "digest": str}
+    defaults = {"name": ""}
+class SERVERBOUND_TransferChunk(packet.Packet):
+    side = packet.SERVER
+    priority = packet.PRIORITY_BULK
+    datavalues = {"tid": int, "offset": int, "data": bytes}
+    defaults = {}
+class SERVERBOUND_TransferEnd(packet.Packet):
+    # stays behind the chunks it closes
+    side = packet.SERVER
+    priority = packet.PRIORITY_BULK
+    datavalues = {"tid": int}
+    defaults = {}
+class SERVERBOUND_TransferAck(packet.Packet):
+    side = packet.SERVER
+    priority = packet.PRIORITY_CONTROL
+    datavalues = {"tid": int, "offset": int, "window": int}
+    defaults = {}
+class SERVERBOUND_TransferAbort(packet.Packet):
+    side = packet.SERVER
+    priority = packet.PRIORITY_CONTROL
+    datavalues = {"tid": int, "reason": str}
+    defaults = {"reason": "no reason specified"}
+class CLIENTBOUND_TransferBegin(packet.Packet):
+    side = packet.CLIENT
+    priority = packet.PRIORITY_INTERACTIVE
+    datavalues = {"tid": int, "name": str, "size": int, "digest": str}
+    defaults = {"name": ""}
+class CLIENTBOUND_TransferChunk(packet.Packet):
+    side = packet.CLIENT
+    priority = packet.PRIORITY_BULK
+    datavalues = {"tid": int, "offset": int, "data": bytes}
+    defaults = {}
+class CLIENTBOUND_TransferEnd(packet.Packet):
+    # stays behind the chunks it closes
+    side = packet.CLIENT
+    priority = packet.PRIORITY_BULK
+    datavalues = {"tid": int}
+    defaults = {}
+class CLIENTBOUND_TransferAck(packet.Packet):
+    side = packet.CLIENT
+    priority = packet.PRIORITY_CONTROL
+    datavalues = {"tid": int, "offset": int, "window": int}
+    defaults = {}
+class CLIENTBOUND_TransferAbort(packet.Packet):
+    side = packet.CLIENT
+    priority = packet.PRIORITY_CONTROL
+    datavalues = {"tid": int, "reason": str}
+    defaults = {"reason": "no reason specified"}
+packet.register(SERVERBOUND_TransferBegin)
+packet.register(SERVERBOUND_TransferChunk)
+packet.register(SERVERBOUND_TransferEnd)
+packet.register(SERVERBOUND_TransferAck)
+packet.register(SERVERBOUND_TransferAbort)
+packet.register(CLIENTBOUND_TransferBegin)
+packet.register(CLIENTBOUND_TransferChunk)
+packet.register(CLIENTBOUND_TransferEnd)
+packet.register(CLIENTBOUND_TransferAck)
+packet.register(CLIENTBOUND_TransferAbort)
+
+TRANSFER = {
+    packet.SERVER: {"begin": SERVERBOUND_TransferBegin, "chunk": SERVERBOUND_TransferChunk, "end": SERVERBOUND_TransferEnd,
+                    "ack": SERVERBOUND_TransferAck, "abort": SERVERBOUND_TransferAbort},
+    packet.CLIENT: {"begin": CLIENTBOUND_TransferBegin, "chunk": CLIENTBOUND_TransferChunk, "end": CLIENTBOUND_TransferEnd,
+                    "ack": CLIENTBOUND_TransferAck, "abort": CLIENTBOUND_TransferAbort},
+}
@@ -1,11 +1,84 @@
 import socket
-import select
 import asyncio
-import time
+import os
+import stat
+import errno
 
 import scalar.exceptions
+import scalar.timerwheel as timerwheel
 from scalar.protocol.socket.constants import *
 
+_HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+
+def unix_path(host: str) -> str|None:
+    if not host.startswith(UNIX_SCHEME):
+        return None
+    return host[len(UNIX_SCHEME):]
+
+def _set_nodelay(sock: socket.socket):
+    # frames go out in a single write, nothing to gain from Nagle
+    if sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+def _wake_waiter(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
+
+def _interleave_families(infos: list[tuple]) -> list[tuple[int, tuple]]:
+    # alternate address families, keeping the resolver's preferred one first
+    families: dict[int, list[tuple]] = {}
+    for family, _, _, _, address in infos:
+        families.setdefault(family, []).append((family, address))
+    addresses = []
+    while families:
+        for family in list(families):
+            addresses.append(families[family].pop(0))
+            if not families[family]:
+                del families[family]
+    return addresses
+
+async def _open_connection(family: int, address) -> socket.socket:
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    try:
+        await asyncio.get_running_loop().sock_connect(sock, address)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+def _close_late(task: asyncio.Task):
+    # an attempt that connected after all must not leave its socket behind
+    if not task.cancelled() and task.exception() is None:
+        task.result().close()
+
+async def _race_connections(addresses: list[tuple[int, tuple]], delay: float) -> socket.socket:
+    # happy eyeballs: a new attempt starts whenever the previous one fails or stalls for longer than delay
+    if not addresses:
+        raise OSError("No addresses to connect to")
+    pending = set()
+    errors = []
+    try:
+        while addresses or pending:
+            if addresses:
+                pending.add(asyncio.create_task(_open_connection(*addresses.pop(0))))
+            done, pending = await asyncio.wait(pending, timeout=delay if addresses else None, return_when=asyncio.FIRST_COMPLETED)
+            winner = None
+            for task in done:
+                if task.exception() is not None:
+                    errors.append(task.exception())
+                elif winner is None:
+                    winner = task.result()
+                else:
+                    task.result().close()
+            if winner is not None:
+                return winner
+        raise errors[0]
+    finally:
+        for task in pending:
+            task.add_done_callback(_close_late)
+            task.cancel()
+
 class BaseSocket:
     host: str = None
     port: int = None
@@ -13,6 +86,15 @@ class BaseSocket:
     _socket: socket.socket = None
     _closed: bool = False
     _bound: bool = False
+    _timeout: float|None = None
+    _read_timeout: float|None = None
+    _read_waiter: asyncio.Future|None = None
+    _write_waiter: asyncio.Future|None = None
+    _recv_buffer: bytearray|None = None
+    _recv_view: memoryview|None = None
+    _recv_start: int = 0
+    _recv_end: int = 0
+    _unix_listener: str|None = None
     def __init__(self, *, host: str, port: int):
         self.host = host
         self.port = port
@@ -20,12 +102,25 @@ class BaseSocket:
     @classmethod
     def fromSocket(cls, host: str, port: int, socket: socket.socket):
         sock = cls(host=host, port=port)
-        socket.settimeout(10)
+        socket.setblocking(False)
+        _set_nodelay(socket)
         sock._socket = socket
+        sock._timeout = 10
+        sock._read_timeout = 10
         sock._closed = False
         sock._bound = False
         return sock
 
+    def settimeout(self, timeout: float|None):
+        self._timeout = timeout
+        self._read_timeout = timeout
+    def gettimeout(self) -> float|None:
+        return self._timeout
+    def setreadtimeout(self, timeout: float|None):
+        self._read_timeout = timeout
+    def getreadtimeout(self) -> float|None:
+        return self._read_timeout
+
     def _socket_available(self):
         if self._socket is None:
             return False
@@ -36,61 +131,173 @@ class BaseSocket:
     def _close(self):
         if not self._socket_available():
             raise scalar.exceptions.SocketLeadsToVoid("Attempt to close a void socket")
-        self._socket.shutdown(socket.SHUT_RDWR)
+        # wake up anyone waiting for readiness before the fd number can be reused
+        fd = self._socket.fileno()
+        for waiter, remove in ((self._read_waiter, "remove_reader"), (self._write_waiter, "remove_writer")):
+            if waiter is None:
+                continue
+            getattr(waiter.get_loop(), remove)(fd)
+            if not waiter.done():
+                waiter.set_exception(scalar.exceptions.SocketBroken("TCP Socket closed while waiting"))
+        self._read_waiter = None
+        self._write_waiter = None
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self._socket.close()
         del self._socket
         self._socket = None
+        # frames already handed out keep their own reference to the old buffer
+        self._recv_buffer = None
+        self._recv_view = None
+        self._recv_start = self._recv_end = 0
         self._closed = True
         self._bound = False
+        if self._unix_listener is not None:
+            try:
+                os.unlink(self._unix_listener)
+            except OSError:
+                pass
+            self._unix_listener = None
 
-    async def _recv(self, amount: int) -> bytes:
+    def _start_deadline(self, writable: bool) -> timerwheel.Timer|None:
+        timeout = self._timeout if writable else self._read_timeout
+        if timeout is None:
+            return None
+        return timerwheel.get_wheel().schedule(timeout, self._expire, writable)
+
+    def _expire(self, writable: bool):
+        waiter = self._write_waiter if writable else self._read_waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_exception(scalar.exceptions.SocketTimedOut())
+
+    async def _wait_ready(self, writable: bool, deadline: timerwheel.Timer|None):
+        # park until epoll reports the socket ready; costs nothing while idle
+        if deadline is not None and deadline.expired:
+            raise scalar.exceptions.SocketTimedOut()
+        loop = asyncio.get_running_loop()
+        sock = self._socket
+        fd = sock.fileno()
+        waiter = loop.create_future()
+        if writable:
+            self._write_waiter = waiter
+            loop.add_writer(fd, _wake_waiter, waiter)
+        else:
+            self._read_waiter = waiter
+            loop.add_reader(fd, _wake_waiter, waiter)
+        try:
+            await waiter
+        finally:
+            if self._socket is sock:
+                if writable:
+                    self._write_waiter = None
+                    loop.remove_writer(fd)
+                else:
+                    self._read_waiter = None
+                    loop.remove_reader(fd)
+
+    async def _peek(self, amount: int) -> memoryview:
+        """
+        Ensures `amount` bytes are buffered and returns a view of them without consuming.
+        The view stays valid until the next receive call.
+        """
         if not self._socket_available():
             raise scalar.exceptions.SocketLeadsToVoid("Attempt to receive data from a void socket")
-        received = b""
-        started = time.time()
-        while len(received) < amount:
-            await asyncio.sleep(0)
-            try:
-                while True:
-                    if not self._socket:
-                        raise scalar.exceptions.SocketBroken("TCP Socket became None")
-                    if time.time() - started > self._socket.gettimeout():
-                        raise scalar.exceptions.SocketTimedOut()
-                    try:
-                        ready1, _, ready2 = select.select([self._socket], [], [self._socket], 0)
-                    except ValueError:
-                        raise scalar.exceptions.SocketBroken(f"TCP Socket file descriptor became invalid value")
-                    if not ready1 and not ready2:
-                        await asyncio.sleep(0)
-                        continue
-                    break
-                r = self._socket.recv(amount - len(received))
-            except socket.timeout:
-                raise scalar.exceptions.SocketTimedOut()
-            except OSError as e:
-                self._close()
-                raise scalar.exceptions.SocketBroken(f"OSError: {e.strerror}")
-            if len(r) == 0:
-                self._close()
-                raise scalar.exceptions.SocketBroken("Length of zero on recv call")
-            received += r
-        return received
+        if self._recv_end - self._recv_start >= amount:
+            return self._recv_view[self._recv_start:self._recv_start+amount]
+        if self._recv_buffer is None or amount > len(self._recv_buffer):
+            # fresh buffer, so views handed out earlier stay intact
+            buffer = bytearray(max(amount, RECV_BUFFER_SIZE))
+            buffered = self._recv_end - self._recv_start
+            if buffered:
+                buffer[:buffered] = self._recv_view[self._recv_start:self._recv_end]
+            self._recv_buffer = buffer
+            self._recv_view = memoryview(buffer)
+            self._recv_start, self._recv_end = 0, buffered
+        elif self._recv_start + amount > len(self._recv_buffer):
+            # move the unfinished tail to the front to make room
+            buffered = self._recv_end - self._recv_start
+            self._recv_view[:buffered] = self._recv_view[self._recv_start:self._recv_end]
+            self._recv_start, self._recv_end = 0, buffered
+        # the read timeout lives on the shared timer wheel and is only armed once we have to wait
+        deadline = None
+        try:
+            while self._recv_end - self._recv_start < amount:
+                if not self._socket:
+                    raise scalar.exceptions.SocketBroken("TCP Socket became None")
+                try:
+                    r = self._socket.recv_into(self._recv_view[self._recv_end:])
+                except (BlockingIOError, InterruptedError):
+                    if deadline is None:
+                        deadline = self._start_deadline(False)
+                    await self._wait_ready(False, deadline)
+                    continue
+                except OSError as e:
+                    self._close()
+                    raise scalar.exceptions.SocketBroken(f"OSError: {e.strerror}")
+                if r == 0:
+                    self._close()
+                    raise scalar.exceptions.SocketBroken("Length of zero on recv call")
+                self._recv_end += r
+        finally:
+            if deadline is not None:
+                deadline.cancel()
+        return self._recv_view[self._recv_start:self._recv_start+amount]
+
+    def _consume(self, amount: int):
+        self._recv_start += amount
+        if self._recv_start == self._recv_end:
+            self._recv_start = self._recv_end = 0
+        buffered = self._recv_end - self._recv_start
+        if len(self._recv_buffer) > RECV_BUFFER_SIZE and buffered <= RECV_BUFFER_SIZE:
+            # a big frame grew the buffer, it is not kept for the rest of the connection.
+            # Frames handed out keep their own reference to the old one
+            buffer = bytearray(RECV_BUFFER_SIZE)
+            buffer[:buffered] = self._recv_view[self._recv_start:self._recv_end]
+            self._recv_buffer = buffer
+            self._recv_view = memoryview(buffer)
+            self._recv_start, self._recv_end = 0, buffered
+
+    async def _recv(self, amount: int) -> bytes:
+        data = bytes(await self._peek(amount))
+        self._consume(amount)
+        return data
     
-    async def _send(self, data: bytes) -> None:
+    async def _sendmsg(self, buffers: list[bytes]) -> None:
         if not self._socket_available():
             raise scalar.exceptions.SocketLeadsToVoid("Attempt to send data to a void socket")
+        views = [memoryview(buffer) for buffer in buffers if len(buffer)]
+        deadline = None
         try:
-            sent = 0
-            while sent < len(data):
-                await asyncio.sleep(0)
+            while views:
                 if not self._socket:
                     raise scalar.exceptions.SocketBroken("TCP Socket became None")
-                sent += self._socket.send(data[sent:])
-        except socket.timeout:
-            raise scalar.exceptions.SocketTimedOut()
-        except OSError as e:
-            self._close()
-            raise scalar.exceptions.SocketBroken(f"OSError: {e.strerror}")
+                try:
+                    if _HAS_SENDMSG:
+                        sent = self._socket.sendmsg(views[:SENDMSG_MAX_BUFFERS])
+                    else:
+                        sent = self._socket.send(views[0])
+                except (BlockingIOError, InterruptedError):
+                    if deadline is None:
+                        deadline = self._start_deadline(True)
+                    await self._wait_ready(True, deadline)
+                    continue
+                except OSError as e:
+                    self._close()
+                    raise scalar.exceptions.SocketBroken(f"OSError: {e.strerror}")
+                # drop what went out, keep a view of the rest of a partially sent buffer
+                while sent:
+                    if sent < len(views[0]):
+                        views[0] = views[0][sent:]
+                        break
+                    sent -= len(views.pop(0))
+        finally:
+            if deadline is not None:
+                deadline.cancel()
+
+    async def _send(self, data: bytes) -> None:
+        await self._sendmsg([data])
     
     async def _accept(self):
         if not self._socket_available():
@@ -98,36 +305,58 @@ class BaseSocket:
         if not self._bound:
             raise scalar.exceptions.SocketAlreadyConnected("Socket is connected socket, not a bound one")
         while True:
-            ready, _, _ = select.select([self._socket], [], [], 0)
-            if not ready:
-                await asyncio.sleep(0)
+            try:
+                conn, addr = self._socket.accept()
+            except (BlockingIOError, InterruptedError):
+                await self._wait_ready(False, None)
                 continue
-            conn, addr = self._socket.accept()
             return addr, conn
 
-    def bind(self, max_connections: int):
+    def bind(self, max_connections: int, reuse_port: bool = False):
         if self._socket_available():
             raise scalar.exceptions.SocketAlreadyConnected("Socket already bound")
         # del self._socket
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self._socket.bind((self.host, self.port))
+        path = unix_path(self.host)
+        if path is not None:
+            # a previous run may have left its socket file behind, anything else at the path is not ours to delete
+            try:
+                if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                    raise FileExistsError(errno.EEXIST, "Not a socket, refusing to replace it", path)
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.bind(path)
+            self._unix_listener = path
+        else:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                # several processes listen on the same port, the kernel spreads connections between them
+                self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self._socket.bind((self.host, self.port))
         self._socket.listen(max_connections)
+        self._socket.setblocking(False)
         self._closed = False
         self._bound = True
 
-    def connect(self):
+    async def connect(self, timeout: float|None = CONNECT_TIMEOUT, delay: float = HAPPY_EYEBALLS_DELAY):
         if self._socket_available():
             raise scalar.exceptions.SocketAlreadyConnected("Socket already connected")
-        # del self._socket
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._socket.settimeout(120)
         try:
-            self._socket.connect((self.host, self.port))
-        except socket.error as exc:
-            del self._socket
-            raise
-        self._socket.settimeout(10)
+            async with asyncio.timeout(timeout):
+                path = unix_path(self.host)
+                if path is not None:
+                    sock = await _open_connection(socket.AF_UNIX, path)
+                else:
+                    infos = await asyncio.get_running_loop().getaddrinfo(self.host, self.port, type=socket.SOCK_STREAM)
+                    sock = await _race_connections(_interleave_families(infos), delay)
+        except TimeoutError:
+            raise scalar.exceptions.SocketTimedOut(f"Connecting to {self.host}:{self.port} timed out") from None
+        self._socket = sock
+        _set_nodelay(self._socket)
+        self._timeout = 10
+        self._read_timeout = 10
         self._closed = False
         self._bound = False
 
@@ -149,8 +378,11 @@ class BaseSocket:
             return SOCKET_TIMEOUT, None
         
     async def send(self, data: bytes) -> int:
+        return await self.sendmsg([data])
+
+    async def sendmsg(self, buffers: list[bytes]) -> int:
         try:
-            await self._send(data)
+            await self._sendmsg(buffers)
             return SOCKET_SUCCESS
         except scalar.exceptions.SocketLeadsToVoid:
             return SOCKET_UNBOUND
@@ -162,6 +394,9 @@ class BaseSocket:
     async def accept(self):
         try:
             addr, conn = await self._accept()
+            if conn.family == socket.AF_UNIX:
+                # unix peers are anonymous, tell them apart by descriptor
+                addr = (self.host, conn.fileno())
             sock = type(self).fromSocket(addr[0], addr[1], conn)
             sock._bound = True
             return addr, sock
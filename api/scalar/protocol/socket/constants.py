@@ -1,4 +1,51 @@
 SOCKET_SUCCESS = 0
 SOCKET_UNBOUND = 1
 SOCKET_BROKENP = 2
-SOCKET_TIMEOUT = 3
\ No newline at end of file
+SOCKET_TIMEOUT = 3
+
+RECV_BUFFER_SIZE = 1 << 17
+SENDMSG_MAX_BUFFERS = 1024
+
+UNIX_SCHEME = "unix://"
+
+CONNECT_TIMEOUT = 30
+# RFC 8305 recommends 250ms between connection attempts
+HAPPY_EYEBALLS_DELAY = 0.25
+
+EXTENSION_FRAME32 = "frame32"
+EXTENSION_MUX = "mux"
+EXTENSION_COMPRESS = "compress:"
+EXTENSION_ZDICT = "zdict:"
+EXTENSION_BATCH = "batch"
+EXTENSION_COUNTER_NONCE = "ctrnonce:"
+NONCE_RANDOM_SIZE = 16
+
+COMPRESSION_NONE = "none"
+COMPRESSION_ZLIB = "zlib"
+COMPRESSION_GZIP = "gzip"
+# one deflate context per direction that lives as long as the connection
+COMPRESSION_STREAM = "zlib-stream"
+COMPRESSIONS = [COMPRESSION_ZLIB, COMPRESSION_GZIP, COMPRESSION_NONE]
+COMPRESSION_LEVEL = 6
+COMPRESSION_THRESHOLD = 256
+# a preset dictionary makes even short packets worth compressing
+DICTIONARY_THRESHOLD = 32
+PAYLOAD_COMPRESSED = 0x01
+# the frame is several payloads, each with its own flags and behind a 4-byte length
+PAYLOAD_BATCH = 0x02
+BATCH_LENGTH_SIZE = 4
+# stays clear of a 2-byte length prefix whatever compression and encryption add
+COALESCE_BUDGET = 32 * 1024
+STREAM_WINDOW_BITS = 15
+STREAM_MEM_LEVEL = 8
+# every Z_SYNC_FLUSH ends with this empty stored block, so it stays off the wire
+SYNC_FLUSH_TAIL = b"\x00\x00\xff\xff"
+
+STREAM_ID_SIZE = 4
+MAX_STREAMS = 64
+
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024
+MAX_DECOMPRESSION_RATIO = 256
+# small packets may legitimately inflate past the ratio, only look at it above this size
+DECOMPRESSION_RATIO_FLOOR = 1024 * 1024
@@ -0,0 +1,174 @@
+import asyncio
+import collections
+
+from scalar.protocol.socket.constants import *
+import scalar.protocol.socket.protosocket as protosocket
+import scalar.protocol.socket.basesocket as basesocket
+import scalar.protocol.encryption
+import scalar.exceptions
+
+class StreamSocket(protosocket.ProtoSocket):
+    """
+    One logical session of a Multiplexer, looks like a ProtoSocket to whoever owns it.
+    """
+    def __init__(self, mux, stream_id: int):
+        super().__init__(host=mux._socket.host, port=mux._socket.port, encryption=scalar.protocol.encryption.BaseEncryption())
+        self._mux = mux
+        self.stream_id = stream_id
+        self._frames = collections.deque()
+        self._closed = False
+        self._bound = mux._socket._bound
+        self._timeout = mux._socket._timeout
+        self._read_timeout = mux._socket._read_timeout
+        self.set_decompression_limits(mux._socket.max_decompressed_size, mux._socket.max_decompression_ratio)
+        self.set_compression(mux._socket.compressions, mux._socket.compression_threshold, mux._socket.window_bits, mux._socket.mem_level)
+        self.dictionaries = mux._socket.dictionaries
+        # every stream keeps its own compression contexts
+        self.use_extensions(mux._socket.extensions)
+
+    def _socket_available(self):
+        return not self._closed
+
+    def _deliver(self, frame: bytes):
+        self._frames.append(frame)
+        if self._read_waiter is not None:
+            basesocket._wake_waiter(self._read_waiter)
+
+    async def _recv_frame(self) -> bytes:
+        while not self._frames:
+            if self._closed:
+                raise scalar.exceptions.SocketBroken("Stream closed while waiting")
+            self._read_waiter = asyncio.get_running_loop().create_future()
+            deadline = self._start_deadline(False)
+            try:
+                await self._read_waiter
+            finally:
+                self._read_waiter = None
+                if deadline is not None:
+                    deadline.cancel()
+        return self._frames.popleft()
+
+    async def _write_frame(self, frame: bytes) -> int:
+        if self._closed:
+            return SOCKET_BROKENP
+        return await self._mux._send(self.stream_id, frame)
+
+    def _close_remote(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._read_waiter is not None and not self._read_waiter.done():
+            self._read_waiter.set_exception(scalar.exceptions.SocketBroken("Stream closed while waiting"))
+
+    def _close(self):
+        if self._closed:
+            raise scalar.exceptions.SocketLeadsToVoid("Attempt to close a void socket")
+        self._close_remote()
+        self._mux._forget(self.stream_id)
+
+class Multiplexer:
+    """
+    Carries many logical sessions over one encrypted ProtoSocket.
+    After the encryption handshake every frame starts with a stream id, a frame with nothing after it closes that stream.
+    The connection goes away together with its last stream.
+    """
+    fingerprint: int|None = None
+    max_streams: int = MAX_STREAMS
+    def __init__(self, sock: protosocket.ProtoSocket):
+        self._socket = sock
+        self._streams: dict[int, StreamSocket] = {}
+        self._incoming: asyncio.Queue = asyncio.Queue()
+        self._next_stream = 0
+        self._highest_stream = -1
+        self._closed = False
+        self._task: asyncio.Task|None = None
+        self._closers: set[asyncio.Task] = set()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def open_stream(self, stream_id: int|None = None) -> StreamSocket:
+        if self._closed:
+            raise scalar.exceptions.SocketBroken("Multiplexed connection is closed")
+        if stream_id is None:
+            stream_id = self._next_stream
+            self._next_stream += 1
+        self._highest_stream = max(self._highest_stream, stream_id)
+        stream = self._streams[stream_id] = StreamSocket(self, stream_id)
+        return stream
+
+    async def accept(self) -> StreamSocket|None:
+        return await self._incoming.get()
+
+    def streams(self) -> int:
+        return len(self._streams)
+
+    async def _run(self):
+        try:
+            while True:
+                stat, frame = await self._socket.recv_frame()
+                if stat != SOCKET_SUCCESS:
+                    return
+                try:
+                    payload = self._socket.encryption.decrypt(frame)
+                except scalar.exceptions.FrameMalformed:
+                    # the stream id is sealed inside, so there is no stream to blame: only the frame goes
+                    continue
+                stream_id = int.from_bytes(payload[:STREAM_ID_SIZE], 'little')
+                stream = self._streams.get(stream_id)
+                if len(payload) == STREAM_ID_SIZE:
+                    if stream is not None:
+                        self._streams.pop(stream_id)
+                        stream._close_remote()
+                        self._close_if_idle()
+                    continue
+                if stream is None:
+                    if not self._socket._bound or stream_id <= self._highest_stream:
+                        # late frames for a stream already closed, ids are never used twice
+                        continue
+                    if len(self._streams) >= self.max_streams:
+                        self._highest_stream = stream_id
+                        self._send_close(stream_id)
+                        continue
+                    stream = self.open_stream(stream_id)
+                    self._incoming.put_nowait(stream)
+                # the receive buffer gets reused, streams keep their own copy
+                stream._deliver(bytes(payload[STREAM_ID_SIZE:]))
+        except scalar.exceptions.LimitExceeded:
+            return
+        finally:
+            self.close()
+
+    async def _send(self, stream_id: int, frame: bytes) -> int:
+        if self._closed:
+            return SOCKET_BROKENP
+        payload = int.to_bytes(stream_id, STREAM_ID_SIZE, 'little') + bytes(frame)
+        return await self._socket.send_encrypted(payload)
+
+    def _forget(self, stream_id: int):
+        if self._streams.pop(stream_id, None) is None or self._closed:
+            return
+        if self._close_if_idle():
+            return
+        self._send_close(stream_id)
+
+    def _send_close(self, stream_id: int):
+        task = asyncio.create_task(self._send(stream_id, b''))
+        self._closers.add(task)
+        task.add_done_callback(self._closers.discard)
+
+    def _close_if_idle(self) -> bool:
+        if self._streams:
+            return False
+        self.close()
+        return True
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._socket.close()
+        for stream in list(self._streams.values()):
+            stream._close_remote()
+        self._streams.clear()
+        self._incoming.put_nowait(None)
@@ -1,8 +1,15 @@
 import gzip
+import os
+import zlib
+import asyncio
+import collections
+import typing
 
 from scalar.protocol.socket.constants import *
 import scalar.protocol.socket.basesocket
+import scalar.exceptions
 import scalar.protocol.encryption
+import scalar.protocol.compression
 import scalar.protocol.packets
 
 class ProtoSocket(scalar.protocol.socket.basesocket.BaseSocket):
@@ -12,31 +19,377 @@ class ProtoSocket(scalar.protocol.socket.basesocket.BaseSocket):
                  encryption: scalar.protocol.encryption.BaseEncryption = scalar.protocol.encryption.BaseEncryption()):
         super().__init__(host=host, port=port)
         self.encryption = encryption
+        # every connection lives on one loop, so frames from different tasks must not interleave
+        self._send_lock = asyncio.Lock()
+        self._header_size = 2
+        self.extensions = []
+        self.max_frame_size = MAX_FRAME_SIZE
+        self.max_decompressed_size = MAX_DECOMPRESSED_SIZE
+        self.max_decompression_ratio = MAX_DECOMPRESSION_RATIO
+        self.compressions = list(COMPRESSIONS)
+        self.compression_threshold = COMPRESSION_THRESHOLD
+        self.window_bits = STREAM_WINDOW_BITS
+        self.mem_level = STREAM_MEM_LEVEL
+        # None until negotiated: every payload is gzip, with no flags byte
+        self.compression: str|None = None
+        self.dictionaries = list(scalar.protocol.compression.DICTIONARIES)
+        self.zdict: bytes|None = None
+        self.zdict_name: str|None = None
+        self._deflater = None
+        self._inflater = None
+        # batches need the flags byte, so they only come with negotiated compression
+        self._batching = False
+        self._unbatched = collections.deque()
+        self._coalesce_window: float|None = None
+        self._coalesce_budget = COALESCE_BUDGET
+        self._coalesced: list[scalar.protocol.packets.Packet|bytes] = []
+        self._coalesced_bytes = 0
+        self._coalesce_handle: asyncio.TimerHandle|None = None
+        self._coalesce_status = SOCKET_SUCCESS
+        self._flushes: set[asyncio.Task] = set()
+        # both ends put a random into the handshake, counter nonces run under a key salted with the two
+        self._nonce_random = os.urandom(NONCE_RANDOM_SIZE)
+        self.nonce_salt: bytes|None = None
 
     def set_encryption(self, encryption: scalar.protocol.encryption.BaseEncryption):
         self.encryption = encryption
+        if self.nonce_salt is not None:
+            encryption.use_counter_nonces(self._bound, self.nonce_salt)
 
-    async def recv_packet(self) -> tuple[int, scalar.protocol.packets.Packet]:
-        stat, length_bytes = await self.recv(2)
-        if stat != SOCKET_SUCCESS:
-            return stat, None
-        length = int.from_bytes(length_bytes, 'little')
-        stat, packet_raw_compressed_encrypted = await self.recv(length)
-        if stat != SOCKET_SUCCESS:
-            return stat, None
-        packet_raw_compressed = self.encryption.decrypt(packet_raw_compressed_encrypted)
-        packet_raw = gzip.decompress(packet_raw_compressed)
-        packet = scalar.protocol.packets.Packet.unpack(
+    def set_max_frame_size(self, max_frame_size: int):
+        self.max_frame_size = max_frame_size
+
+    def set_decompression_limits(self, max_size: int, max_ratio: float):
+        self.max_decompressed_size = max_size
+        self.max_decompression_ratio = max_ratio
+
+    def set_compression(self, compressions: list[str], threshold: int = COMPRESSION_THRESHOLD,
+                        window_bits: int = STREAM_WINDOW_BITS, mem_level: int = STREAM_MEM_LEVEL):
+        self.compressions = list(compressions)
+        self.compression_threshold = threshold
+        self.window_bits = window_bits
+        self.mem_level = mem_level
+
+    def set_dictionaries(self, dictionaries: list[str]):
+        self.dictionaries = [name for name in dictionaries if name in scalar.protocol.compression.DICTIONARIES]
+
+    def set_coalescing(self, window: float|None, budget: int = COALESCE_BUDGET):
+        # packets sent within window seconds of each other share a frame, until budget bytes are waiting
+        self._coalesce_window = window
+        self._coalesce_budget = budget
+
+    def offer_extensions(self) -> list[str]:
+        return [EXTENSION_FRAME32, EXTENSION_BATCH, EXTENSION_COUNTER_NONCE + self._nonce_random.hex()] + \
+               [EXTENSION_COMPRESS + compression for compression in self.compressions] + \
+               [EXTENSION_ZDICT + name for name in self.dictionaries]
+
+    def accept_extensions(self, offered: list[str]) -> list[str]:
+        # sessions are only multiplexed when the client asks for it
+        accepted = [extension for extension in offered if extension in (EXTENSION_FRAME32, EXTENSION_BATCH, EXTENSION_MUX)]
+        # offers come in the client's order of preference, the first one we support wins
+        for prefix, supported in ((EXTENSION_COMPRESS, self.compressions), (EXTENSION_ZDICT, self.dictionaries)):
+            for extension in offered:
+                if extension.startswith(prefix) and extension[len(prefix):] in supported:
+                    accepted.append(extension)
+                    break
+        for extension in offered:
+            if extension.startswith(EXTENSION_COUNTER_NONCE) and len(extension) == len(EXTENSION_COUNTER_NONCE) + 2 * NONCE_RANDOM_SIZE:
+                # the client's random, then ours
+                accepted.append(extension + self._nonce_random.hex())
+                break
+        return accepted
+
+    def use_extensions(self, extensions: list[str]):
+        self.extensions = list(extensions)
+        if EXTENSION_FRAME32 in extensions:
+            self._header_size = 4
+        for extension in extensions:
+            if extension.startswith(EXTENSION_COMPRESS):
+                self.compression = extension[len(EXTENSION_COMPRESS):]
+            if extension.startswith(EXTENSION_ZDICT):
+                self.zdict_name = extension[len(EXTENSION_ZDICT):]
+                self.zdict = scalar.protocol.compression.DICTIONARIES[self.zdict_name]
+            if extension.startswith(EXTENSION_COUNTER_NONCE):
+                try:
+                    randoms = bytes.fromhex(extension[len(EXTENSION_COUNTER_NONCE):])
+                except ValueError:
+                    randoms = b""
+                if len(randoms) != 2 * NONCE_RANDOM_SIZE:
+                    raise scalar.exceptions.FrameMalformed(f"Counter nonce extension carries {len(randoms)} random bytes")
+                # the client goes by its own random, whatever the answer claims it was
+                client_random = randoms[:NONCE_RANDOM_SIZE] if self._bound else self._nonce_random
+                self.nonce_salt = client_random + randoms[NONCE_RANDOM_SIZE:]
+        self._batching = EXTENSION_BATCH in extensions and self.compression is not None
+        if self.compression == COMPRESSION_STREAM:
+            # window_bits and mem_level only size our deflater, the inflater must fit any window the peer picked
+            self._deflater = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -self.window_bits, self.mem_level, **self._zdict())
+            self._inflater = zlib.decompressobj(-STREAM_WINDOW_BITS, **self._zdict())
+
+    def _zdict(self) -> dict:
+        # zlib has no "no dictionary" value for zdict, it has to be left out
+        return {} if self.zdict is None else {"zdict": self.zdict}
+
+    async def _recv_frame(self) -> memoryview:
+        header_size = self._header_size
+        length = int.from_bytes(await self._peek(header_size), 'little')
+        # refuse before the receive buffer grows to fit the frame
+        if length > self.max_frame_size:
+            raise scalar.exceptions.FrameTooLarge(f"Frame of {length} bytes exceeds maximum of {self.max_frame_size}")
+        frame = (await self._peek(header_size + length))[header_size:]
+        self._consume(header_size + length)
+        return frame
+
+    def _compress(self, packet_raw: bytes) -> bytes:
+        if self.compression is None:
+            return gzip.compress(packet_raw)
+        if self.compression == COMPRESSION_STREAM:
+            # small packets gain the most from the shared history, so the threshold does not apply
+            compressed = self._deflater.compress(packet_raw) + self._deflater.flush(zlib.Z_SYNC_FLUSH)
+            return bytes((PAYLOAD_COMPRESSED,)) + compressed[:-len(SYNC_FLUSH_TAIL)]
+        threshold = self.compression_threshold if self.zdict is None else min(self.compression_threshold, DICTIONARY_THRESHOLD)
+        if self.compression == COMPRESSION_NONE or len(packet_raw) < threshold:
+            # headers and trailers would outweigh anything saved on small payloads
+            return bytes((0,)) + packet_raw
+        if self.compression == COMPRESSION_ZLIB and self.zdict is not None:
+            # raw deflate, both ends already know which dictionary the frame needs
+            deflater = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -15, zdict=self.zdict)
+            compressed = deflater.compress(packet_raw) + deflater.flush()
+        elif self.compression == COMPRESSION_ZLIB:
+            compressed = zlib.compress(packet_raw, COMPRESSION_LEVEL)
+        else:
+            compressed = gzip.compress(packet_raw, COMPRESSION_LEVEL)
+        if len(compressed) >= len(packet_raw):
+            return bytes((0,)) + packet_raw
+        return bytes((PAYLOAD_COMPRESSED,)) + compressed
+
+    def _wire_key(self) -> tuple|None:
+        # a streaming context depends on everything sent before, its output fits this connection only
+        if self.compression == COMPRESSION_STREAM:
+            return None
+        return (self.compression, self.compression_threshold, self.zdict_name)
+
+    def _payload(self, packet: scalar.protocol.packets.Packet|bytes) -> bytes:
+        if not isinstance(packet, scalar.protocol.packets.Packet):
+            return self._compress(packet)
+        key = self._wire_key()
+        if key is None:
+            return self._compress(packet.packed())
+        # every socket compressing the same way shares one compressed copy, only encryption is per socket
+        return packet.wire(key, self._compress)
+
+    def _decompress(self, data: bytes) -> bytes:
+        if not data:
+            raise scalar.exceptions.FrameMalformed("Empty payload")
+        if self.compression is None:
+            return self._inflate(data, 31)
+        if not data[0] & PAYLOAD_COMPRESSED:
+            return data[1:]
+        if self.compression == COMPRESSION_ZLIB:
+            return self._inflate(data[1:], 15 if self.zdict is None else -15)
+        if self.compression == COMPRESSION_GZIP:
+            return self._inflate(data[1:], 31)
+        if self.compression == COMPRESSION_STREAM:
+            return self._inflate_stream(bytes(data[1:]) + SYNC_FLUSH_TAIL)
+        raise scalar.exceptions.FrameMalformed("Compressed payload on a connection that negotiated no compression")
+
+    def _inflate_limit(self, data: bytes) -> int:
+        return min(self.max_decompressed_size, max(int(len(data) * self.max_decompression_ratio), DECOMPRESSION_RATIO_FLOOR))
+
+    def _inflate_stream(self, data: bytes) -> bytes:
+        limit = self._inflate_limit(data)
+        try:
+            packet_raw = self._inflater.decompress(data, limit + 1)
+        except zlib.error as e:
+            raise scalar.exceptions.FrameMalformed(f"Corrupt compressed frame: {e}") from None
+        if len(packet_raw) > limit:
+            # the shared context is unusable from here on, so is the connection
+            raise scalar.exceptions.DecompressionLimitExceeded(f"Frame of {len(data)} bytes inflates past {limit} bytes")
+        return packet_raw
+
+    def _inflate(self, data: bytes, wbits: int) -> bytes:
+        limit = self._inflate_limit(data)
+        decompressor = zlib.decompressobj(wbits, **(self._zdict() if wbits < 0 else {}))
+        # never inflate more than one byte past the limit
+        try:
+            packet_raw = decompressor.decompress(data, limit + 1)
+        except zlib.error as e:
+            raise scalar.exceptions.FrameMalformed(f"Corrupt compressed frame: {e}") from None
+        if len(packet_raw) > limit:
+            raise scalar.exceptions.DecompressionLimitExceeded(f"Frame of {len(data)} bytes inflates past {limit} bytes")
+        if not decompressor.eof:
+            raise scalar.exceptions.FrameMalformed("Incomplete or truncated compressed frame")
+        return packet_raw
+
+    async def recv_frame(self) -> tuple[int, memoryview|None]:
+        try:
+            return SOCKET_SUCCESS, await self._recv_frame()
+        except scalar.exceptions.SocketLeadsToVoid:
+            return SOCKET_UNBOUND, None
+        except scalar.exceptions.SocketBroken:
+            return SOCKET_BROKENP, None
+        except scalar.exceptions.SocketTimedOut:
+            return SOCKET_TIMEOUT, None
+
+    def _unpack(self, packet_raw: bytes) -> scalar.protocol.packets.Packet:
+        return scalar.protocol.packets.Packet.unpack(
             scalar.protocol.packets.SERVER if self._bound else scalar.protocol.packets.CLIENT,
             packet_raw
         )
-        return SOCKET_SUCCESS, packet
+
+    def _unbatch(self, body: bytes):
+        # unpack everything now, body may point into the receive buffer
+        body = memoryview(body)
+        offset = 0
+        while offset < len(body):
+            length = int.from_bytes(body[offset:offset + BATCH_LENGTH_SIZE], 'little')
+            offset += BATCH_LENGTH_SIZE
+            if length == 0 or offset + length > len(body):
+                raise scalar.exceptions.FrameMalformed(f"Batched packet of {length} bytes overruns its frame")
+            self._unbatched.append(self._unpack(self._decompress(body[offset:offset + length])))
+            offset += length
+        if not self._unbatched:
+            raise scalar.exceptions.FrameMalformed("Empty batch")
+
+    async def _next_packet(self) -> scalar.protocol.packets.Packet:
+        if self._unbatched:
+            return self._unbatched.popleft()
+        packet_raw_compressed_encrypted = await self._recv_frame()
+        packet_raw_compressed = self.encryption.decrypt(packet_raw_compressed_encrypted)
+        if self._batching and packet_raw_compressed[0] & PAYLOAD_BATCH:
+            self._unbatch(packet_raw_compressed[1:])
+            return self._unbatched.popleft()
+        return self._unpack(self._decompress(packet_raw_compressed))
+
+    async def recv_packet(self) -> tuple[int, scalar.protocol.packets.Packet]:
+        try:
+            return SOCKET_SUCCESS, await self._next_packet()
+        except scalar.exceptions.SocketLeadsToVoid:
+            return SOCKET_UNBOUND, None
+        except scalar.exceptions.SocketBroken:
+            return SOCKET_BROKENP, None
+        except scalar.exceptions.SocketTimedOut:
+            return SOCKET_TIMEOUT, None
+
+    async def packets(self) -> typing.AsyncIterator[scalar.protocol.packets.Packet]:
+        # frames already sitting in the receive buffer are unpacked without touching the socket again
+        while True:
+            try:
+                packet = await self._next_packet()
+            except scalar.exceptions.SocketTimedOut:
+                continue
+            except scalar.exceptions.SocketLeadsToVoid as e:
+                raise scalar.exceptions.SocketBroken(str(e)) from e
+            yield packet
     
     async def send_packet(self, packet: scalar.protocol.packets.Packet) -> int:
-        packet_raw = packet.pack()
-        packet_raw_compressed = gzip.compress(packet_raw)
-        packet_raw_compressed_encrypted = self.encryption.encrypt(packet_raw_compressed)
-        length = len(packet_raw_compressed_encrypted)
-        length_bytes = int.to_bytes(length, 2, 'little')
-        await self.send(length_bytes)
-        return await self.send(packet_raw_compressed_encrypted)
\ No newline at end of file
+        # control packets don't wait for the coalescing window, they overtake what is gathered so far
+        if self._coalesce_window is not None and self._batching and packet.priority != scalar.protocol.packets.PRIORITY_CONTROL:
+            return await self._coalesce(packet)
+        return await self._send_payloads([packet])
+
+    async def send_packed(self, packet_raw: bytes) -> int:
+        if self._coalesce_window is not None and self._batching:
+            return await self._coalesce(packet_raw)
+        return await self._send_payloads([packet_raw])
+
+    async def send_batch(self, packets: list[scalar.protocol.packets.Packet|bytes]) -> int:
+        if not self._batching:
+            for packet in packets:
+                stat = await self._send_payloads([packet])
+                if stat != SOCKET_SUCCESS:
+                    return stat
+            return SOCKET_SUCCESS
+        return await self._send_payloads(packets)
+
+    async def _send_payloads(self, packets: list[scalar.protocol.packets.Packet|bytes]) -> int:
+        # streaming compression must hit the wire in the order it was done
+        async with self._send_lock:
+            payloads = [self._payload(packet) for packet in packets]
+            if len(payloads) == 1:
+                body = payloads[0]
+            else:
+                # every packet keeps its own compression, so cached payloads can be batched as they are
+                body = bytes((PAYLOAD_BATCH,)) + b"".join(int.to_bytes(len(payload), BATCH_LENGTH_SIZE, 'little') + payload for payload in payloads)
+            return await self._write_encrypted(body)
+
+    async def _coalesce(self, packet: scalar.protocol.packets.Packet|bytes) -> int:
+        # failures surface on the next send, the reader sees the broken socket anyway
+        if self._coalesce_status != SOCKET_SUCCESS:
+            return self._coalesce_status
+        size = len(packet.packed()) if isinstance(packet, scalar.protocol.packets.Packet) else len(packet)
+        if size >= self._coalesce_budget:
+            await self.flush()
+            return await self._send_payloads([packet])
+        if self._coalesced_bytes + size > self._coalesce_budget:
+            self._flush_coalesced()
+        self._coalesced.append(packet)
+        self._coalesced_bytes += size
+        if self._coalesce_handle is None:
+            self._coalesce_handle = asyncio.get_running_loop().call_later(self._coalesce_window, self._flush_coalesced)
+        return SOCKET_SUCCESS
+
+    def _flush_coalesced(self):
+        if self._coalesce_handle is not None:
+            self._coalesce_handle.cancel()
+            self._coalesce_handle = None
+        if not self._coalesced:
+            return
+        batch, self._coalesced, self._coalesced_bytes = self._coalesced, [], 0
+        # tasks take the send lock in the order they were made, so batches stay in order
+        task = asyncio.create_task(self._send_coalesced(batch))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _send_coalesced(self, batch: list[scalar.protocol.packets.Packet|bytes]):
+        try:
+            stat = await self.send_batch(batch)
+        except scalar.exceptions.ScalarException:
+            stat = SOCKET_BROKENP
+        if stat != SOCKET_SUCCESS:
+            self._coalesce_status = stat
+
+    async def flush(self) -> int:
+        self._flush_coalesced()
+        if self._flushes:
+            await asyncio.gather(*self._flushes)
+        return self._coalesce_status
+
+    def pending(self) -> bool:
+        return bool(self._coalesced or self._flushes)
+
+    def close(self) -> int:
+        # whatever is still coalescing goes down with the socket, aclose() sends it first
+        if self._coalesce_handle is not None:
+            self._coalesce_handle.cancel()
+            self._coalesce_handle = None
+        self._coalesced, self._coalesced_bytes = [], 0
+        for task in self._flushes:
+            task.cancel()
+        return super().close()
+
+    async def aclose(self) -> int:
+        await self.flush()
+        return self.close()
+
+    async def send_frame(self, frame: bytes) -> int:
+        async with self._send_lock:
+            return await self._write_frame(frame)
+
+    async def send_encrypted(self, payload: bytes) -> int:
+        # counted nonces must be used up in wire order, and only by frames that actually go out
+        async with self._send_lock:
+            return await self._write_encrypted(payload)
+
+    async def _write_encrypted(self, payload: bytes) -> int:
+        # a frame refused for its size must not have taken a nonce
+        self._check_frame(len(payload) + self.encryption.overhead())
+        return await self._write_frame(self.encryption.encrypt(payload))
+
+    def _check_frame(self, size: int):
+        if size >= 1 << (8 * self._header_size):
+            raise scalar.exceptions.FrameTooLarge(f"Frame of {size} bytes doesn't fit a {self._header_size}-byte length prefix")
+
+    async def _write_frame(self, frame: bytes) -> int:
+        self._check_frame(len(frame))
+        length_bytes = int.to_bytes(len(frame), self._header_size, 'little')
+        return await self.sendmsg([length_bytes, frame])
\ No newline at end of file
@@ -1,15 +1,24 @@
 import asyncio
 import typing
-import random
 import os
+import time
+import collections
+import contextvars
 
 import scalar.protocol.encryption as encryption
 import scalar.protocol.socket.protosocket as protosocket
 import scalar.protocol.packets.protocol as protocol
 import scalar.primitives as primitives
+import scalar.exceptions as exceptions
+import scalar.timerwheel as timerwheel
+import scalar.server.lifecycle as lifecycle
+import scalar.transfer as transfer
 
 ALLOWED_USERNAME_CHARACTERS = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-._"
 
+# client whose packet is being processed, everything queued meanwhile is put on its tab
+_origin: contextvars.ContextVar = contextvars.ContextVar("origin", default=None)
+
 class BaseClient:
     _address: tuple[str, int] = None
     _socket: protosocket.ProtoSocket = None
@@ -20,30 +29,121 @@ class BaseClient:
     _username_n: int = 0
     _fingerprint: str|None = None
     _user: primitives.User|None = None
+    _task: asyncio.Task|None = None
+    _writer_task: asyncio.Task|None = None
+    _outbound: list[collections.deque]|None = None
+    _outbound_bytes: int = 0
+    _outbound_ready: asyncio.Event|None = None
+    _backpressure: bool = False
+    _heartbeat: timerwheel.Timer|None = None
+    _heartbeats_missed: int = 0
+    _last_seen: float = 0
+    _inbound_debt: int = 0
+    _throttled: bool = False
+    _debt_drained: asyncio.Event|None = None
+    _lifecycle: lifecycle.Lifecycle|None = None
+    _closing: bool = False
+    _transfers: transfer.Transfers|None = None
     def __init__(self, server, addr: tuple[str, int], sock: protosocket.ProtoSocket):
         self._server = server
         self._address = addr
         self._socket = sock
-        sock._socket.settimeout(10)
+        sock.settimeout(10)
+        # one lane per priority, control packets never wait behind bulk ones
+        self._outbound = [collections.deque() for _ in range(protocol.packet.PRIORITIES)]
+        self._outbound_ready = asyncio.Event()
+        self._debt_drained = asyncio.Event()
+        self._lifecycle = server._connections.open(lambda e: self._invoke_event("on_exception", e))
+        self._lifecycle.defer(self._release_socket)
+        self._lifecycle.defer(self._clear_outbound)
+        self._lifecycle.defer(self._log_out)
 
     def format_address(self):
         return f"{self._address[0]}:{self._address[1]}"
     
     def _end_it_all(self):
-        self._logged_in = False
+        self._lifecycle.close()
+        if self._task is not None and self._task is not asyncio.current_task():
+            # someone else (broadcast, another client's handler) closed us, our tasks are cancelled
+            return
+        raise exceptions.ClientDisconnected()
+
+    def _release_socket(self):
         self._socket.close()
-        self._server._client_close(self)
-        # os._exit(0) # we're a thread, kill ourselves
-        exit()
+        # drop the session keys along with the connection
+        self._socket.set_encryption(encryption.BaseEncryption())
+
+    def _log_out(self):
+        self._logged_in = False
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
 
     async def kick(self, reason: str = "No reason specified"):
+        if self._closing:
+            return self._end_it_all()
+        self._closing = True
         await self._invoke_event("on_kick", reason)
+        # whatever is still queued is moot, the kick goes out right away
+        self._clear_outbound()
         await self._socket.send_packet(protocol.CLIENTBOUND_Kick(reason=reason))
         self._end_it_all()
-    
-    def run(self):
-        asyncio.run(self.serve())
 
+    async def send_transfer(self, data: bytes, name: str = "", tid: int|None = None) -> int:
+        if self._transfers is None:
+            raise exceptions.TransferAborted("Client is not logged in")
+        return await self._transfers.send(data, name, tid)
+
+    def _open_transfers(self):
+        self._transfers = transfer.Transfers(protocol.packet.CLIENT, self._send_packet, self._transfer_received,
+                                             self._server._claim_partials(self._fingerprint),
+                                             accept=self._server._transfers_accepted,
+                                             max_size=self._server._max_transfer_size,
+                                             budget=self._server._transfer_budget)
+        self._lifecycle.defer(self._close_transfers)
+
+    async def _transfer_received(self, tid: int, name: str, data: bytes):
+        # the handler may answer with a transfer of its own, whose acknowledgements this reader has to take
+        self._lifecycle.spawn(self._invoke_event("on_transfer", tid, name, data))
+
+    def _close_transfers(self):
+        self._transfers.close()
+        self._server._park_partials(self._fingerprint)
+
+    def queued_bytes(self) -> int:
+        return self._outbound_bytes
+
+    def inbound_debt(self) -> int:
+        return self._inbound_debt
+
+    def _clear_outbound(self):
+        for lane in self._outbound:
+            for packet, packet_raw, origin in lane:
+                if origin is not None:
+                    origin._repay(len(packet_raw))
+            lane.clear()
+        self._outbound_bytes = 0
+
+    def _repay(self, amount: int):
+        self._inbound_debt -= amount
+        if self._throttled and self._inbound_debt <= self._server._inbound_debt_low:
+            self._debt_drained.set()
+
+    async def _throttle(self):
+        # stop reading until what we were made to send has gone out, TCP pushes back on the sender meanwhile
+        if self._inbound_debt <= self._server._inbound_debt_high:
+            return
+        if self._writer_task.done():
+            # nothing drains any more, reading is how we find out the connection is gone
+            return
+        self._throttled = True
+        self._debt_drained.clear()
+        await self._invoke_event("on_throttle", True)
+        try:
+            await self._debt_drained.wait()
+        finally:
+            self._throttled = False
+        await self._invoke_event("on_throttle", False)
+    
     async def _invoke_event(self, event_name: str, *event_args: list[typing.Any], **event_kwargs: dict[str, typing.Any]):
         return await self._server._invoke_event(self, event_name, *event_args, **event_kwargs)
 
@@ -54,7 +154,7 @@ class BaseClient:
         if stat != protosocket.SOCKET_SUCCESS:
             return self._end_it_all()
         if type(packet) is not protocol.SERVERBOUND_HANDSHAKE_EncryptionSupported:
-            return self.kick(f"Expected SERVERBOUND_HANDSHAKE_EncryptionSupported, got {type(packet).__name__}")
+            return await self.kick(f"Expected SERVERBOUND_HANDSHAKE_EncryptionSupported, got {type(packet).__name__}")
         selected = None
         for i in range(len(packet.encryptions)-1, -1, -1):
             if packet.encryptions[i] not in encryption.SUPPORTED:
@@ -62,7 +162,7 @@ class BaseClient:
             selected = i
             break
         if selected is None:
-            return self.kick(f"Couldn't agree on encryption")
+            return await self.kick(f"Couldn't agree on encryption")
         
         if await self._socket.send_packet(protocol.CLIENTBOUND_HANDSHAKE_EncryptionSelect(select=selected)) != protosocket.SOCKET_SUCCESS:
             return self._end_it_all()
@@ -87,22 +187,97 @@ class BaseClient:
 
         await self._invoke_event("on_encrypted", packet.key)
 
+    def _enqueue(self, packet: protocol.packet.Packet, packet_raw: bytes, origin = None) -> bool:
+        if self._outbound_bytes + len(packet_raw) > self._server._write_queue_limit:
+            return False
+        self._outbound[packet.priority].append((packet, packet_raw, origin))
+        self._outbound_bytes += len(packet_raw)
+        self._outbound_ready.set()
+        if origin is not None:
+            origin._inbound_debt += len(packet_raw)
+        return True
+
     async def _send_packet(self, packet: protocol.packet.Packet):
-        if await self._socket.send_packet(packet) != protosocket.SOCKET_SUCCESS:
-            await self._invoke_event("on_socket_broken")
+        # a recipient that is already backed up is dealt with by the write watermarks, not by stalling the sender
+        origin = _origin.get() if not self._backpressure else None
+        if origin is self:
+            # a sender that stopped being read can't read its own echoes either
+            origin = None
+        if not self._enqueue(packet, packet.packed(), origin):
+            # peer isn't reading, no point in trying to tell it why
+            if not self._closing:
+                self._closing = True
+                await self._invoke_event("on_kick", "Outbound queue overflow")
             return self._end_it_all()
-        if self._logged_in:
-            await self._invoke_event("on_packet_sent", packet)
+        await self._update_backpressure()
+
+    async def _update_backpressure(self):
+        if not self._backpressure and self._outbound_bytes > self._server._write_high_watermark:
+            self._backpressure = True
+            await self._invoke_event("on_backpressure", True)
+        elif self._backpressure and self._outbound_bytes <= self._server._write_low_watermark:
+            self._backpressure = False
+            await self._invoke_event("on_backpressure", False)
+
+    async def _writer(self):
+        while True:
+            if not any(self._outbound):
+                self._outbound_ready.clear()
+                await self._outbound_ready.wait()
+                continue
+            control = self._outbound[protocol.packet.PRIORITY_CONTROL]
+            if self._server._coalesce_window and not control and self._outbound_bytes < self._server._coalesce_budget:
+                # give a burst the chance to share one frame, control packets never wait for company
+                await asyncio.sleep(self._server._coalesce_window)
+            # whatever piled up while the last frame was being written goes out as one, most urgent lanes first
+            batch = []
+            size = 0
+            for lane in self._outbound:
+                while lane and (not batch or size + len(lane[0][1]) <= self._server._coalesce_budget):
+                    batch.append(lane.popleft())
+                    size += len(batch[-1][1])
+                if lane:
+                    break
+            try:
+                stat = await self._socket.send_batch([packet for packet, _, _ in batch])
+            except exceptions.FrameTooLarge as e:
+                await self._invoke_event("on_exception", e)
+                continue
+            finally:
+                self._outbound_bytes -= size
+                for _, packet_raw, origin in batch:
+                    if origin is not None:
+                        origin._repay(len(packet_raw))
+            if stat != protosocket.SOCKET_SUCCESS:
+                # the reader finds the socket closed and reports it, so it is only reported once
+                self._socket.close()
+                self._debt_drained.set()
+                return
+            if self._logged_in:
+                for packet, _, _ in batch:
+                    await self._invoke_event("on_packet_sent", packet)
+            await self._update_backpressure()
         
+    async def _broken(self):
+        if not self._closing:
+            self._closing = True
+            await self._invoke_event("on_socket_broken")
+        return self._end_it_all()
+
+    async def _received(self, packet: protocol.packet.Packet):
+        # any inbound traffic proves the peer is alive
+        self._last_seen = time.monotonic()
+        self._heartbeats_missed = 0
+        if self._logged_in:
+            await self._invoke_event("on_packet_received", packet)
+
     async def _recv_packet(self, expect: protocol.packet.Packet|None = None) -> protocol.packet.Packet:
         stat, packet = await self._socket.recv_packet()
         if stat == protosocket.SOCKET_TIMEOUT:
             return None
         if stat != protosocket.SOCKET_SUCCESS:
-            await self._invoke_event("on_socket_broken")
-            return self._end_it_all()
-        if self._logged_in:
-            await self._invoke_event("on_packet_received", packet)
+            return await self._broken()
+        await self._received(packet)
         if type(packet) is expect:
             return packet
         if expect is not None and type(packet) is not expect:
@@ -114,7 +289,7 @@ class BaseClient:
         uinfo = await self._recv_packet(protocol.SERVERBOUND_LOGIN_UserInfo)
         self._original_username = uinfo.username
         if any(ch not in ALLOWED_USERNAME_CHARACTERS for ch in self._original_username):
-            return self.kick("Unallowed characters in username")
+            return await self.kick("Unallowed characters in username")
         for client in self._server.clients():
             if client._original_username != uinfo.username: continue
             if client == self: continue
@@ -132,45 +307,65 @@ class BaseClient:
 
         return True
     
-    async def recv_packets(self):
-        heartbeats_missed = 0
-        queue = []
-        expect_nonce = None
-        while True:
-            packet = await self._recv_packet()
-
-            # send client heartbeat (check client responsiveness)
-            if not packet:
-                expect_nonce = random.randint(0, 65535)
-                await self._send_packet(protocol.CLIENTBOUND_CHeartbeat(nonce=expect_nonce))
-                heartbeats_missed += 1
-                if heartbeats_missed > 1:
-                    await self._invoke_event("heartbeat_missed", heartbeats_missed-1)
-            if heartbeats_missed >= 6:
-                await self.kick("Heartbeat stopped (missed 5 heartbeat attempts)")
-            if not packet:
-                continue
-            if type(packet) is protocol.SERVERBOUND_CHeartbeat:
-                if packet.nonce == expect_nonce:
-                    heartbeats_missed = 0
-                continue
+    def _arm_heartbeat(self, delay: float):
+        self._heartbeat = timerwheel.get_wheel().schedule(delay, self._heartbeat_due)
 
-            # reply to server heartbeat (checking server responsiveness)
-            if type(packet) is protocol.SERVERBOUND_SHeartbeat:
-                await self._invoke_event("heartbeat", packet.nonce)
-                await self._send_packet(protocol.CLIENTBOUND_SHeartbeat(nonce=packet.nonce))
-                continue
+    def _heartbeat_due(self):
+        silence = time.monotonic() - self._last_seen
+        if self._throttled:
+            # we are the ones not reading, its answers are sitting in the socket
+            silence = 0
+        if silence < self._server._heartbeat_interval:
+            # busy connection, heard from it recently enough
+            return self._arm_heartbeat(self._server._heartbeat_interval - silence)
+        self._server._queue_probe(self)
 
-            queue.append(packet)
-            if heartbeats_missed > 0:
-                continue
-            return queue
+    async def _heartbeat_packet(self, packet: protocol.packet.Packet) -> bool:
+        # answer to our probe, liveness is already recorded
+        if type(packet) is protocol.SERVERBOUND_CHeartbeat:
+            return True
+
+        # reply to server heartbeat (checking server responsiveness)
+        if type(packet) is protocol.SERVERBOUND_SHeartbeat:
+            await self._invoke_event("heartbeat", packet.nonce)
+            await self._send_packet(protocol.CLIENTBOUND_SHeartbeat(nonce=packet.nonce))
+            return True
+        return False
+
+    async def packets(self) -> typing.AsyncIterator[protocol.packet.Packet]:
+        try:
+            async for packet in self._socket.packets():
+                await self._received(packet)
+                if await self._heartbeat_packet(packet):
+                    continue
+                if self._transfers is not None and self._transfers.handles(packet):
+                    await self._transfers.receive(packet)
+                    continue
+                yield packet
+        except exceptions.SocketBroken:
+            pass
+        await self._broken()
     
     async def serve(self):
-        await self._protocol_connect()
-        await self._protocol_login()
-        self._user = primitives.User(self._username, self._fingerprint)
-        await self._invoke_event('on_login_complete')
-        while True:
-            for packet in await self.recv_packets():
-                await self._server._process_packet(self, type(packet), packet)
\ No newline at end of file
+        self._writer_task = self._lifecycle.spawn(self._writer())
+        try:
+            try:
+                await self._protocol_login()
+                self._user = primitives.User(self._username, self._fingerprint)
+                self._open_transfers()
+                await self._invoke_event('on_login_complete')
+                # liveness is tracked by the heartbeat timer from here on, reads may idle forever
+                self._socket.setreadtimeout(None)
+                self._last_seen = time.monotonic()
+                self._arm_heartbeat(self._server._heartbeat_interval)
+                async for packet in self.packets():
+                    token = _origin.set(self)
+                    try:
+                        await self._server._process_packet(self, type(packet), packet)
+                    finally:
+                        _origin.reset(token)
+                    await self._throttle()
+            except (exceptions.LimitExceeded, exceptions.FrameMalformed) as e:
+                await self.kick(f"{type(e).__name__}: {e}")
+        except exceptions.ClientDisconnected:
+            return
\ No newline at end of file
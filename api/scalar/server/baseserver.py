@@ -1,36 +1,151 @@
 import scalar.protocol.encryption as encryption
+import scalar.protocol.compression as compression
 import scalar.protocol.packets.protocol as protocol
 import scalar.protocol.socket.protosocket as protosocket
+import scalar.protocol.socket.multiplex as multiplex
 import scalar.exceptions as exceptions
+import scalar.timerwheel as timerwheel
+import scalar.metrics as metrics
+import scalar.transfer as transfer
 
 import scalar.server.baseclient as baseclient
+import scalar.server.workerpool as workerpool
+import scalar.server.lifecycle as lifecycle
 
-import threading
 import typing
 import asyncio
 import traceback
+import random
 
 VERSION = 1
+# what all unfinished incoming transfers together may hold, parked ones included
+TRANSFER_BUDGET = 64 * 1024 * 1024
 
 class BaseServer:
     _socket: protosocket.ProtoSocket|None = None
-    _clients: dict[str, baseclient.BaseClient] = {}
+    _peer: protosocket.ProtoSocket|None = None
+    _peer_task: asyncio.Task|None = None
+    _clients: set[baseclient.BaseClient]|None = None
+    _connections: lifecycle.ConnectionManager|None = None
     _keys: dict[str, typing.Any] = {}
     _client_class: type = baseclient.BaseClient
     _implementation: str = 'base'
+    _write_high_watermark: int = 256 * 1024
+    _write_low_watermark: int = 64 * 1024
+    _write_queue_limit: int = 4 * 1024 * 1024
+    _inbound_debt_high: int = 1024 * 1024
+    _inbound_debt_low: int = 256 * 1024
+    _max_frame_size: int = protosocket.MAX_FRAME_SIZE
+    _max_decompressed_size: int = protosocket.MAX_DECOMPRESSED_SIZE
+    _max_decompression_ratio: float = protosocket.MAX_DECOMPRESSION_RATIO
+    _compressions: list[str] = protosocket.COMPRESSIONS
+    _compression_threshold: int = protosocket.COMPRESSION_THRESHOLD
+    _compression_window_bits: int = protosocket.STREAM_WINDOW_BITS
+    _compression_mem_level: int = protosocket.STREAM_MEM_LEVEL
+    _dictionaries: list[str] = list(compression.DICTIONARIES)
+    _coalesce_window: float = 0
+    _coalesce_budget: int = protosocket.COALESCE_BUDGET
+    _handshake_timeout: float = 10
+    _max_handshakes: int = 256
+    _multiplex: bool = True
+    _max_streams: int = protosocket.MAX_STREAMS
+    _handshakes: asyncio.Semaphore|None = None
+    _handshake_tasks: set[asyncio.Task]|None = None
+    _heartbeat_interval: float = 10
+    _heartbeat_misses: int = 5
+    _probe_batch: list[baseclient.BaseClient]|None = None
+    _probe_tasks: set[asyncio.Task]|None = None
+    _heartbeat_meter: metrics.RateMeter|None = None
+    _transfers_accepted: bool = False
+    _max_transfer_size: int = transfer.MAX_TRANSFER_SIZE
+    _transfer_budget: transfer.Budget|None = None
+    _transfer_resume_window: float = 60
+    _transfer_partials: dict[str, dict]|None = None
+    _transfer_holders: dict[str, int]|None = None
+    _transfer_expiry: dict[str, timerwheel.Timer]|None = None
     def __init__(self):
+        self._clients = set()
+        self._transfer_partials = {}
+        self._transfer_holders = {}
+        self._transfer_expiry = {}
+        self._transfer_budget = transfer.Budget(TRANSFER_BUDGET)
+        self._connections = lifecycle.ConnectionManager()
+        self._probe_batch = []
+        self._probe_tasks = set()
+        self._heartbeat_meter = metrics.RateMeter()
         @self.event("on_exception")
         def print_exception(self, client, e):
-            print(f"Exception occured for client {client.format_address()}, ignoring")
+            if client is None:
+                print("Exception occured during a handshake, ignoring")
+            else:
+                print(f"Exception occured for client {client.format_address()}, ignoring")
             print("".join(traceback.format_exception(e))[:-1])
 
-    def bind(self, host: str, port: int):
+    def bind(self, host: str, port: int = 0):
+        self._listen(host, port)
+
+    def _listen(self, host: str, port: int, reuse_port: bool = False):
         self._socket = protosocket.ProtoSocket(
             host=host,
             port=port,
             encryption=encryption.BaseEncryption # aka no encryption
         )
-        self._socket.bind(128)
+        self._socket.bind(128, reuse_port)
+
+    def set_write_buffer_limits(self, high: int|None = None, low: int|None = None, limit: int|None = None):
+        if high is None:
+            high = type(self)._write_high_watermark if low is None else low * 4
+        if low is None:
+            low = high // 4
+        if limit is None:
+            limit = max(self._write_queue_limit, high)
+        if not low <= high <= limit:
+            raise ValueError(f"write buffer limits must satisfy low <= high <= limit, got {low}, {high}, {limit}")
+        self._write_high_watermark = high
+        self._write_low_watermark = low
+        self._write_queue_limit = limit
+
+    def set_inbound_limits(self, high: int, low: int|None = None):
+        if low is None:
+            low = high // 4
+        if not low <= high:
+            raise ValueError(f"inbound limits must satisfy low <= high, got {low}, {high}")
+        self._inbound_debt_high = high
+        self._inbound_debt_low = low
+
+    def set_heartbeat(self, interval: float|None = None, misses: int|None = None):
+        if interval is not None:
+            if interval <= 0:
+                raise ValueError(f"heartbeat interval must be positive, got {interval}")
+            self._heartbeat_interval = interval
+        if misses is not None:
+            self._heartbeat_misses = misses
+
+    def set_coalescing(self, window: float|None, budget: int = protosocket.COALESCE_BUDGET):
+        self._coalesce_window = window
+        self._coalesce_budget = budget
+
+    def set_transfers(self, accept: bool = True, max_size: int = transfer.MAX_TRANSFER_SIZE,
+                      budget: int|None = TRANSFER_BUDGET, resume_window: float|None = None):
+        # clients can't send transfers until this is called
+        self._transfers_accepted = accept
+        self._max_transfer_size = max_size
+        self._transfer_budget.limit = budget
+        if resume_window is not None:
+            self._transfer_resume_window = resume_window
+
+    def queued_bytes(self) -> dict[str, int]:
+        return {client.format_address(): client.queued_bytes() for client in self._clients}
+
+    def metrics(self) -> dict[str, float]:
+        return {
+            "clients": len(self._clients),
+            "connections": len(self._connections),
+            "connection_tasks": self._connections.tasks(),
+            "heartbeats_sent": self._heartbeat_meter.total(),
+            "heartbeat_rate": self._heartbeat_meter.rate(),
+            "transfer_bytes": self._transfer_budget.used,
+        }
 
     _events: dict[str, list[typing.Callable]] = {}
     def event(self, event_name: str):
@@ -48,6 +163,8 @@ class BaseServer:
                 call = getattr(self, "event_"+event_name)(client, *event_args, **event_kwargs)
                 if call is not None:
                     await call
+            except (asyncio.CancelledError, exceptions.ClientDisconnected):
+                raise
             except BaseException as e:
                 await self._invoke_event(client, "on_exception", e)
         if self._events.get(event_name) is None:
@@ -58,6 +175,8 @@ class BaseServer:
                 if call is None:
                     continue
                 await call
+            except (asyncio.CancelledError, exceptions.ClientDisconnected):
+                raise
             except BaseException as e:
                 await self._invoke_event(client, "on_exception", e)
 
@@ -74,43 +193,204 @@ class BaseServer:
             raise exceptions.EncryptionKeysUnsupported()
         self._keys[key_type] = keypair.generate()
 
-    def run(self):
+    def run(self, workers: int = 1):
+        if workers > 1:
+            return workerpool.run_workers(self, workers)
         asyncio.run(self.serve())
+
+    def _worker_setup(self, index: int, count: int):
+        pass
     
     async def serve(self):
+        self._handshakes = asyncio.Semaphore(self._max_handshakes)
+        self._handshake_tasks = set()
+        if self._peer is not None:
+            self._peer_task = asyncio.create_task(self._serve_peer())
         while True:
             addr, sock = await self._socket.accept()
             if addr is None:
                 raise exceptions.SocketBroken()
-            stat, packet = await sock.recv_packet()
-            if stat != protosocket.SOCKET_SUCCESS:
-                continue
-            if type(packet) is not protocol.SERVERBOUND_HANDSHAKE_Hello:
-                await sock.send_packet(protocol.CLIENTBOUND_Kick(reason=f"Expected SERVERBOUND_HANDSHAKE_Hello, got {type(packet).__name__}"))
-                sock.close()
-                continue
-            if packet.version != VERSION:
-                await sock.send_packet(protocol.CLIENTBOUND_Kick(reason=f"Mismatched versions: Client={packet.version}, Server={VERSION}"))
-                sock.close()
-                continue
-            if await sock.send_packet(protocol.CLIENTBOUND_HANDSHAKE_Hello(version=VERSION)) != protosocket.SOCKET_SUCCESS:
-                continue
-            cl = self._client_class(self, addr, sock)
-            self._clients[cl.format_address()] = cl
-            threading.Thread(target=cl.run, daemon=True).start()
+            # a slow or silent peer must never hold up the accept loop
+            self._spawn(self._handshake(addr, sock))
+
+    def _spawn(self, coro: typing.Coroutine):
+        # no local outlives this call, a finished connection must not stay pinned until the next accept
+        task = asyncio.create_task(coro)
+        self._handshake_tasks.add(task)
+        task.add_done_callback(self._handshake_tasks.discard)
+
+    async def _handshake(self, addr: tuple[str, int], sock: protosocket.ProtoSocket):
+        cl = None
+        task = asyncio.current_task()
+        async with self._handshakes:
+            # the deadline shares the wheel with the socket and heartbeat ones, the loop's own timers stay free
+            deadline = timerwheel.get_wheel().schedule(self._handshake_timeout, task.cancel)
+            try:
+                cl = await self._greet(addr, sock)
+            except asyncio.CancelledError:
+                if not deadline.expired:
+                    raise
+                # our own deadline, whatever the task awaits next must not see it as a cancellation
+                task.uncancel()
+            except (exceptions.LimitExceeded, exceptions.FrameMalformed):
+                pass
+            except Exception as e:
+                # there is no client yet to blame it on
+                await self._invoke_event(None, "on_exception", e)
+            finally:
+                deadline.cancel()
+                if cl is None:
+                    sock.close()
+        if cl is None:
+            return
+        if isinstance(cl._socket, multiplex.StreamSocket):
+            self._spawn(self._accept_streams(cl._address, cl._socket._mux))
+        await self._serve_client(cl)
+
+    async def _serve_client(self, cl: baseclient.BaseClient):
+        self._clients.add(cl)
+        cl._lifecycle.defer(self._client_close, cl)
+        cl._task = asyncio.current_task()
+        cl._lifecycle.adopt(cl._task)
+        try:
+            await cl.serve()
+        except Exception as e:
+            await self._invoke_event(cl, "on_exception", e)
+        finally:
+            cl._lifecycle.close()
+
+    async def _accept_streams(self, addr: tuple[str, int], mux: multiplex.Multiplexer):
+        # every further session on a multiplexed connection logs in on its own, without a handshake
+        while True:
+            stream = await mux.accept()
+            if stream is None:
+                return
+            cl = self._client_class(self, (addr[0], f"{addr[1]}#{stream.stream_id}"), stream)
+            cl._fingerprint = encryption.fingerprint_stream(mux.fingerprint, stream.stream_id)
+            self._spawn(self._serve_client(cl))
+
+    async def _greet(self, addr: tuple[str, int], sock: protosocket.ProtoSocket) -> baseclient.BaseClient|None:
+        sock.set_max_frame_size(self._max_frame_size)
+        sock.set_decompression_limits(self._max_decompressed_size, self._max_decompression_ratio)
+        sock.set_compression(self._compressions, self._compression_threshold, self._compression_window_bits, self._compression_mem_level)
+        sock.set_dictionaries(self._dictionaries)
+        stat, packet = await sock.recv_packet()
+        if stat != protosocket.SOCKET_SUCCESS:
+            return None
+        if type(packet) is not protocol.SERVERBOUND_HANDSHAKE_Hello:
+            await sock.send_packet(protocol.CLIENTBOUND_Kick(reason=f"Expected SERVERBOUND_HANDSHAKE_Hello, got {type(packet).__name__}"))
+            return None
+        if packet.version != VERSION:
+            await sock.send_packet(protocol.CLIENTBOUND_Kick(reason=f"Mismatched versions: Client={packet.version}, Server={VERSION}"))
+            return None
+        extensions = sock.accept_extensions(packet.extensions)
+        if not self._multiplex and protosocket.EXTENSION_MUX in extensions:
+            extensions.remove(protosocket.EXTENSION_MUX)
+        if await sock.send_packet(protocol.CLIENTBOUND_HANDSHAKE_Hello(version=VERSION, extensions=extensions)) != protosocket.SOCKET_SUCCESS:
+            return None
+        sock.use_extensions(extensions)
+        cl = self._client_class(self, addr, sock)
+        try:
+            await cl._protocol_connect()
+        except exceptions.ClientDisconnected:
+            return None
+        except BaseException:
+            cl._lifecycle.close()
+            raise
+        if protosocket.EXTENSION_MUX in extensions:
+            # the connection only carries sessions from now on, the handshake one becomes stream 0
+            mux = multiplex.Multiplexer(sock)
+            mux.fingerprint = cl._fingerprint
+            mux.max_streams = self._max_streams
+            cl._socket = mux.open_stream(0)
+            sock.setreadtimeout(None)
+            mux.start()
+        return cl
             
+    def _queue_probe(self, client: baseclient.BaseClient):
+        # every probe due in this tick goes out from a single task
+        if not self._probe_batch:
+            task = asyncio.create_task(self._send_probes())
+            self._probe_tasks.add(task)
+            task.add_done_callback(self._probe_tasks.discard)
+        self._probe_batch.append(client)
+
+    async def _send_probes(self):
+        batch, self._probe_batch = self._probe_batch, []
+        probe = protocol.CLIENTBOUND_CHeartbeat(nonce=random.randint(0, 65535))
+        for client in batch:
+            if not client._logged_in: continue
+            client._heartbeats_missed += 1
+            if client._heartbeats_missed > self._heartbeat_misses:
+                client._lifecycle.spawn(client.kick(f"Heartbeat stopped (missed {self._heartbeat_misses} heartbeat attempts)"))
+                continue
+            client._arm_heartbeat(self._heartbeat_interval)
+            client._enqueue(probe, probe.packed())
+            self._heartbeat_meter.add()
+            if client._heartbeats_missed > 1:
+                await client._invoke_event("heartbeat_missed", client._heartbeats_missed - 1)
+
     def _client_close(self, client):
-        del self._clients[client.format_address()]
+        self._clients.discard(client)
+
+    def _claim_partials(self, fingerprint: str) -> dict:
+        expiry = self._transfer_expiry.pop(fingerprint, None)
+        if expiry is not None:
+            expiry.cancel()
+        # one key may be logged in more than once, they all share its partials
+        self._transfer_holders[fingerprint] = self._transfer_holders.get(fingerprint, 0) + 1
+        return self._transfer_partials.setdefault(fingerprint, {})
+
+    def _park_partials(self, fingerprint: str):
+        self._transfer_holders[fingerprint] -= 1
+        if self._transfer_holders[fingerprint]:
+            # another connection with the same key is still using them
+            return
+        del self._transfer_holders[fingerprint]
+        # unfinished incoming transfers wait a while for the same key to come back and resume them
+        if not self._transfer_partials.get(fingerprint):
+            self._transfer_partials.pop(fingerprint, None)
+            return
+        if fingerprint not in self._transfer_expiry:
+            self._transfer_expiry[fingerprint] = timerwheel.get_wheel().schedule(self._transfer_resume_window, self._expire_partials, fingerprint)
+
+    def _expire_partials(self, fingerprint: str):
+        self._transfer_expiry.pop(fingerprint, None)
+        partials = self._transfer_partials.pop(fingerprint, {})
+        for incoming in partials.values():
+            self._transfer_budget.release(incoming.size)
+        # emptied too, whoever still holds the dict can't release the same bytes again
+        partials.clear()
 
     def clients(self):
         clients = self._clients.copy()
-        for client in clients.values():
+        for client in clients:
             yield client
 
     async def broadcast(self, packet: protocol.packet.Packet, except_clients: list = []):
         for client in self.clients():
             if client in except_clients: continue
+            # clients still logging in expect login packets only
+            if not client._logged_in: continue
             await client._send_packet(packet)
+        if self._peer is not None:
+            await self._peer.send_packet(packet)
+
+    async def _serve_peer(self):
+        # broadcasts made by the other worker processes
+        while True:
+            stat, packet = await self._peer.recv_packet()
+            if stat != protosocket.SOCKET_SUCCESS:
+                # hub is gone, stop accepting so this worker winds down
+                self._socket.close()
+                return
+            await self._process_peer_packet(packet)
+            for client in self.clients():
+                if not client._logged_in: continue
+                await client._send_packet(packet)
+
+    async def _process_peer_packet(self, packet: protocol.packet.Packet):
+        pass
 
     async def _process_packet(self, client, packet_type: type, packet: protocol.packet.Packet):
         pass
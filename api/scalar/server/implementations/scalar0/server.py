@@ -33,6 +33,27 @@ class Scalar0Server(BaseServer):
             messages = self._state.load_channel_messages(cid)
             self._channellist.append(primitives.Channel(cid, name, messages))
     
+    def _worker_setup(self, index: int, count: int):
+        self._identifier.partition(index, count)
+
+    async def _process_peer_packet(self, packet: protocol.packet.Packet):
+        # keep the user list and channel history in step with the other workers
+        if type(packet) is protocol.CLIENTBOUND_EventUserJoined:
+            self._userlist.append(packet.user)
+            return
+        if type(packet) is protocol.CLIENTBOUND_EventUserLeft:
+            user = self.find_user_by_fingerprint(packet.fingerprint)
+            if user is not None:
+                self._userlist.remove(user)
+            return
+        if type(packet) is protocol.CLIENTBOUND_UserMessage:
+            channel = self.find_channel(packet.channel)
+            if channel is None:
+                return
+            author = self.find_user_by_fingerprint(packet.user)
+            channel.push_message(primitives.Message(mid=packet.mid, channel=channel, author=author, content=packet.message))
+            return
+
     async def event_on_login_complete(self, client: Scalar0Client):
         self._userlist.append(client._user)
         await self.broadcast(protocol.CLIENTBOUND_EventUserJoined(user=client._user))
@@ -55,7 +76,7 @@ class Scalar0Server(BaseServer):
         mid = self._identifier.get_identifier(identifier.UNIVERSE_MESSAGE)
         message = primitives.Message(mid=mid, channel=channel, author=None, content=message)
         channel.push_message(message)
-        return await self.broadcast(protocol.CLIENTBOUND_ServerMessage(mid=mid, channel=channel.cid, message=message))
+        return await self.broadcast(protocol.CLIENTBOUND_ServerMessage(mid=mid, channel=channel.cid, message=message.content))
     
     async def _process_packet(self, client: Scalar0Client, packet_type: type, packet: protocol.packet.Packet):
         if packet_type is protocol.SERVERBOUND_UserListRequest:
@@ -0,0 +1,80 @@
+import asyncio
+import typing
+
+import scalar.exceptions as exceptions
+
+class Lifecycle:
+    """
+    Everything one connection owns: its tasks and the finalizers that give back the rest.
+    Closing runs the finalizers newest first and cancels the tasks, exactly once however the connection ends.
+    """
+    def __init__(self, manager, on_error: typing.Callable|None = None):
+        self._manager = manager
+        self._on_error = on_error
+        self._tasks: set[asyncio.Task] = set()
+        self._finalizers: list[tuple[typing.Callable, tuple]] = []
+        self.closed = False
+
+    def adopt(self, task: asyncio.Task):
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def spawn(self, coro: typing.Coroutine) -> asyncio.Task:
+        task = asyncio.create_task(self._guard(coro))
+        self.adopt(task)
+        return task
+
+    def defer(self, callback: typing.Callable, *args):
+        self._finalizers.append((callback, args))
+
+    def tasks(self) -> int:
+        return len(self._tasks)
+
+    async def _guard(self, coro: typing.Coroutine):
+        try:
+            return await coro
+        except exceptions.ClientDisconnected:
+            return
+        except Exception as e:
+            # a task that dies must not leave the rest of the connection behind
+            if self._on_error is not None:
+                await self._on_error(e)
+            self.close()
+
+    def close(self) -> bool:
+        if self.closed:
+            return False
+        self.closed = True
+        while self._finalizers:
+            callback, args = self._finalizers.pop()
+            try:
+                callback(*args)
+            except Exception as e:
+                asyncio.get_running_loop().call_exception_handler({"message": "Exception in connection finalizer", "exception": e})
+        current = asyncio.current_task()
+        for task in list(self._tasks):
+            if task is not current:
+                task.cancel()
+        self._manager._discard(self)
+        return True
+
+class ConnectionManager:
+    """
+    Registry of the lifecycles that are still open.
+    """
+    def __init__(self):
+        self._live: set[Lifecycle] = set()
+
+    def open(self, on_error: typing.Callable|None = None) -> Lifecycle:
+        lifecycle = Lifecycle(self, on_error)
+        self._live.add(lifecycle)
+        return lifecycle
+
+    def _discard(self, lifecycle: Lifecycle):
+        self._live.discard(lifecycle)
+
+    def __len__(self) -> int:
+        return len(self._live)
+
+    def tasks(self) -> int:
+        return sum(lifecycle.tasks() for lifecycle in self._live)
@@ -0,0 +1,98 @@
+import asyncio
+import os
+import signal
+import socket
+import traceback
+
+import scalar.protocol.socket.protosocket as protosocket
+import scalar.protocol.socket.basesocket as basesocket
+import scalar.exceptions as exceptions
+
+# workers talk over local socketpairs, compressing there only burns cpu
+WORKER_EXTENSIONS = [protosocket.EXTENSION_FRAME32, protosocket.EXTENSION_COMPRESS + protosocket.COMPRESSION_NONE]
+
+class WorkerHub:
+    _peers: list[protosocket.ProtoSocket] = None
+
+    def __init__(self, connections: list[socket.socket]):
+        self._peers = []
+        for index, connection in enumerate(connections):
+            peer = protosocket.ProtoSocket.fromSocket('worker', index, connection)
+            peer.settimeout(None)
+            peer.use_extensions(WORKER_EXTENSIONS)
+            self._peers.append(peer)
+
+    async def _relay(self, peer: protosocket.ProtoSocket):
+        while True:
+            stat, frame = await peer.recv_frame()
+            if stat != protosocket.SOCKET_SUCCESS:
+                self._peers.remove(peer)
+                return
+            frame = bytes(frame)
+            for other in self._peers:
+                if other is peer: continue
+                await other.send_frame(frame)
+
+    async def serve(self):
+        await asyncio.gather(*[self._relay(peer) for peer in self._peers])
+
+def run_workers(server, count: int):
+    if not hasattr(os, "fork") or not hasattr(socket, "SO_REUSEPORT"):
+        raise exceptions.ServerWorkersUnsupported()
+    host = server._socket.host
+    if basesocket.unix_path(host) is not None:
+        raise exceptions.ServerWorkersUnsupported("unix sockets can't be shared with SO_REUSEPORT")
+    # port 0 is resolved here, or every worker would end up on an ephemeral port of its own
+    port = server._socket._socket.getsockname()[1]
+    # every worker binds its own listening socket, the parent must not listen on the port
+    server._socket.close()
+    server._socket = None
+    # but holds on to it, bound and never listening a socket takes no connections
+    reservation = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    reservation.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    reservation.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    reservation.bind((host, port))
+
+    pids = []
+    hub_connections = []
+    for index in range(count):
+        hub_end, worker_end = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            reservation.close()
+            hub_end.close()
+            for connection in hub_connections:
+                connection.close()
+            code = 0
+            try:
+                server._listen(host, port, reuse_port=True)
+                server._peer = protosocket.ProtoSocket.fromSocket('hub', 0, worker_end)
+                server._peer.settimeout(None)
+                server._peer.use_extensions(WORKER_EXTENSIONS)
+                server._worker_setup(index, count)
+                asyncio.run(server.serve())
+            except (KeyboardInterrupt, exceptions.SocketBroken):
+                pass
+            except BaseException:
+                # os._exit below would swallow the exception, so it is reported here
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        worker_end.close()
+        hub_connections.append(hub_end)
+        pids.append(pid)
+
+    try:
+        asyncio.run(WorkerHub(hub_connections).serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in pids:
+            os.waitpid(pid, 0)
+        reservation.close()
@@ -0,0 +1,134 @@
+import asyncio
+import weakref
+import typing
+
+RESOLUTION = 0.1
+SLOTBITS = 6
+SLOTS = 1 << SLOTBITS
+SLOTMASK = SLOTS - 1
+LEVELS = 4
+
+class Timer:
+    __slots__ = ("deadline", "callback", "args", "cancelled", "expired", "_slot", "_wheel")
+
+    def __init__(self, wheel, deadline: int, callback: typing.Callable, args: tuple):
+        self._wheel = wheel
+        self._slot = None
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.expired = False
+
+    def cancel(self):
+        if self.cancelled or self.expired:
+            return
+        self.cancelled = True
+        self._slot.discard(self)
+        self._wheel._count -= 1
+
+class TimerWheel:
+    """
+    Hashed hierarchical timer wheel, one per event loop.
+    Scheduling and cancelling are O(1), a tick only touches the slot that is due.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop, resolution: float = RESOLUTION):
+        self._loop = loop
+        self._resolution = resolution
+        self._wheels = [[set() for _ in range(SLOTS)] for _ in range(LEVELS)]
+        self._origin = loop.time()
+        self._tick = 0
+        self._count = 0
+        self._handle: asyncio.TimerHandle|None = None
+
+    def _now(self) -> int:
+        return int((self._loop.time() - self._origin) / self._resolution)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def schedule(self, delay: float, callback: typing.Callable, *args) -> Timer:
+        now = self._now()
+        if self._count == 0:
+            # nothing is pending, so nothing can be skipped by jumping ahead
+            self._tick = now
+        ticks = max(1, int(-(-delay // self._resolution)))
+        timer = Timer(self, now + ticks, callback, args)
+        self._insert(timer)
+        self._count += 1
+        self._arm(timer.deadline)
+        return timer
+
+    def _insert(self, timer: Timer):
+        ticks = max(0, timer.deadline - self._tick)
+        deadline = self._tick + ticks
+        for level in range(LEVELS):
+            if ticks < 1 << (SLOTBITS * (level + 1)) or level == LEVELS - 1:
+                slot = self._wheels[level][(deadline >> (SLOTBITS * level)) & SLOTMASK]
+                slot.add(timer)
+                timer._slot = slot
+                return
+
+    def _arm(self, tick: int):
+        when = self._origin + tick * self._resolution
+        if self._handle is not None:
+            if self._handle.when() <= when:
+                return
+            self._handle.cancel()
+        self._handle = self._loop.call_at(when, self._run)
+
+    def _next_tick(self) -> int:
+        # sleep through empty slots, up to the next cascade at the latest
+        wheel = self._wheels[0]
+        distance = SLOTS - (self._tick & SLOTMASK)
+        for step in range(1, distance):
+            if wheel[(self._tick + step) & SLOTMASK]:
+                return self._tick + step
+        return self._tick + distance
+
+    def _run(self):
+        self._handle = None
+        now = self._now()
+        while self._tick < now and self._count:
+            self._advance()
+        if self._count == 0:
+            self._tick = now
+            return
+        self._arm(self._next_tick())
+
+    def _advance(self):
+        self._tick += 1
+        for level in range(1, LEVELS):
+            if self._tick & ((1 << (SLOTBITS * level)) - 1):
+                break
+            index = (self._tick >> (SLOTBITS * level)) & SLOTMASK
+            timers = self._wheels[level][index]
+            self._wheels[level][index] = set()
+            for timer in timers:
+                self._insert(timer)
+        index = self._tick & SLOTMASK
+        due = self._wheels[0][index]
+        if not due:
+            return
+        self._wheels[0][index] = set()
+        for timer in due:
+            if timer.deadline > self._tick:
+                # clamped into the top level, not due yet
+                self._insert(timer)
+                continue
+            timer.expired = True
+            self._count -= 1
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                self._loop.call_exception_handler({"message": "Exception in timer wheel callback", "exception": e})
+
+_wheels: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+def get_wheel(loop: asyncio.AbstractEventLoop|None = None) -> TimerWheel:
+    if loop is None:
+        loop = asyncio.get_running_loop()
+    wheel = _wheels.get(loop)
+    if wheel is None:
+        wheel = _wheels[loop] = TimerWheel(loop)
+    return wheel
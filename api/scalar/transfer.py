@@ -0,0 +1,187 @@
+import asyncio
+import hashlib
+import random
+import typing
+
+import scalar.protocol.packets.protocol as protocol
+import scalar.exceptions as exceptions
+
+CHUNK_SIZE = 16 * 1024
+WINDOW = 128 * 1024
+MAX_TRANSFER_SIZE = 8 * 1024 * 1024
+MAX_PARTIALS = 2
+
+class _Outgoing:
+    def __init__(self):
+        self.acked: int|None = None
+        self.window: int = 0
+        self.error: exceptions.TransferAborted|None = None
+        self.changed = asyncio.Event()
+
+class _Incoming:
+    def __init__(self, name: str, size: int, digest: str):
+        self.name = name
+        self.size = size
+        self.digest = digest
+        self.data = bytearray()
+        self.acked = 0
+
+class Budget:
+    """
+    Bytes incoming transfers may hold at once, shared by every connection that takes them in.
+    A transfer holds its whole size from begin until it completes, fails or its partial is dropped.
+    """
+    def __init__(self, limit: int|None = None):
+        self.limit = limit
+        self.used = 0
+
+    def reserve(self, size: int) -> bool:
+        if self.limit is not None and self.used + size > self.limit:
+            return False
+        self.used += size
+        return True
+
+    def release(self, size: int):
+        self.used -= size
+
+class Transfers:
+    """
+    Moves blobs too large for one packet over a connection, both ways: begin, chunks, end.
+    The receiver hands out a window of bytes the sender may have in flight and acknowledges as it reads,
+    chunks go out as bulk packets so chat keeps flowing alongside.
+    What a receiver got so far stays in partials, a sender that begins the same transfer again continues from there.
+    """
+    def __init__(self, side: str, send: typing.Callable, deliver: typing.Callable, partials: dict|None = None, *,
+                 accept: bool = True, max_size: int = MAX_TRANSFER_SIZE, budget: Budget|None = None):
+        # side is the one our packets are bound for
+        self._packets = protocol.TRANSFER[side]
+        self._kinds = {cls: kind for kind, cls in protocol.TRANSFER[protocol.packet.CLIENT if side == protocol.packet.SERVER else protocol.packet.SERVER].items()}
+        self._send = send
+        self._deliver = deliver
+        self._outgoing: dict[int, _Outgoing] = {}
+        self._partials: dict[int, _Incoming] = {} if partials is None else partials
+        self._accept = accept
+        self._max_size = max_size
+        self._budget = Budget() if budget is None else budget
+        self._closed = False
+
+    def handles(self, packet: protocol.packet.Packet) -> bool:
+        return type(packet) in self._kinds
+
+    async def receive(self, packet: protocol.packet.Packet):
+        await getattr(self, "_" + self._kinds[type(packet)])(packet)
+
+    async def send(self, data: bytes, name: str = "", tid: int|None = None) -> int:
+        if self._closed:
+            raise exceptions.TransferAborted("Connection closed")
+        if tid is None:
+            tid = random.getrandbits(62)
+        if tid in self._outgoing:
+            raise exceptions.TransferAborted(f"Transfer {tid} is already running")
+        data = bytes(data)
+        outgoing = self._outgoing[tid] = _Outgoing()
+        try:
+            await self._send(self._packets["begin"](tid=tid, name=name, size=len(data), digest=hashlib.sha256(data).hexdigest()))
+            # the first acknowledgement says where to start, past whatever an earlier attempt left behind
+            await self._wait(outgoing, lambda: outgoing.acked is not None)
+            sent = outgoing.acked
+            while sent < len(data):
+                await self._wait(outgoing, lambda: sent < outgoing.acked + outgoing.window)
+                end = min(len(data), outgoing.acked + outgoing.window, sent + CHUNK_SIZE)
+                await self._send(self._packets["chunk"](tid=tid, offset=sent, data=data[sent:end]))
+                sent = end
+            await self._send(self._packets["end"](tid=tid))
+            await self._wait(outgoing, lambda: outgoing.acked == len(data) and outgoing.window == 0)
+        finally:
+            self._outgoing.pop(tid, None)
+        return tid
+
+    async def abort(self, tid: int, reason: str = "Cancelled"):
+        self._drop(tid)
+        outgoing = self._outgoing.get(tid)
+        if outgoing is not None:
+            self._fail(outgoing, reason)
+        await self._send(self._packets["abort"](tid=tid, reason=reason))
+
+    def close(self):
+        # partials stay with whoever handed them in, so the transfer can resume on the next connection
+        self._closed = True
+        for outgoing in self._outgoing.values():
+            self._fail(outgoing, "Connection closed")
+
+    def _fail(self, outgoing: _Outgoing, reason: str):
+        if outgoing.error is None:
+            outgoing.error = exceptions.TransferAborted(reason)
+        outgoing.changed.set()
+
+    async def _wait(self, outgoing: _Outgoing, ready: typing.Callable):
+        while True:
+            if outgoing.error is not None:
+                raise outgoing.error
+            if ready():
+                return
+            outgoing.changed.clear()
+            await outgoing.changed.wait()
+
+    def _drop(self, tid: int) -> _Incoming|None:
+        incoming = self._partials.pop(tid, None)
+        if incoming is not None:
+            self._budget.release(incoming.size)
+        return incoming
+
+    async def _refuse(self, tid: int, reason: str):
+        self._drop(tid)
+        await self._send(self._packets["abort"](tid=tid, reason=reason))
+
+    async def _begin(self, packet: protocol.packet.Packet):
+        if not self._accept:
+            return await self._refuse(packet.tid, "Transfers are not accepted")
+        if not 0 <= packet.size <= self._max_size:
+            return await self._refuse(packet.tid, f"Transfer of {packet.size} bytes is over the {self._max_size} byte limit")
+        incoming = self._partials.get(packet.tid)
+        if incoming is None or incoming.size != packet.size or incoming.digest != packet.digest:
+            self._drop(packet.tid)
+            if len(self._partials) >= MAX_PARTIALS:
+                return await self._refuse(packet.tid, f"Too many transfers at once, at most {MAX_PARTIALS}")
+            if not self._budget.reserve(packet.size):
+                return await self._refuse(packet.tid, "Out of room for transfers, try again later")
+            incoming = self._partials[packet.tid] = _Incoming(packet.name, packet.size, packet.digest)
+        incoming.acked = len(incoming.data)
+        await self._send(self._packets["ack"](tid=packet.tid, offset=incoming.acked, window=WINDOW))
+
+    async def _chunk(self, packet: protocol.packet.Packet):
+        incoming = self._partials.get(packet.tid)
+        if incoming is None:
+            # refused or aborted already, the rest of the window is still on its way
+            return
+        end = packet.offset + len(packet.data)
+        if packet.offset != len(incoming.data) or end > incoming.size or end > incoming.acked + WINDOW:
+            return await self._refuse(packet.tid, f"Chunk at {packet.offset} is out of order or past the window")
+        incoming.data += packet.data
+        # the last bytes are acknowledged by the answer to end
+        if end < incoming.size and end - incoming.acked >= WINDOW // 2:
+            incoming.acked = end
+            await self._send(self._packets["ack"](tid=packet.tid, offset=end, window=WINDOW))
+
+    async def _end(self, packet: protocol.packet.Packet):
+        incoming = self._drop(packet.tid)
+        if incoming is None:
+            return
+        if len(incoming.data) != incoming.size or hashlib.sha256(incoming.data).hexdigest() != incoming.digest:
+            return await self._refuse(packet.tid, "Digest mismatch")
+        await self._send(self._packets["ack"](tid=packet.tid, offset=incoming.size, window=0))
+        await self._deliver(packet.tid, incoming.name, bytes(incoming.data))
+
+    async def _ack(self, packet: protocol.packet.Packet):
+        outgoing = self._outgoing.get(packet.tid)
+        if outgoing is None:
+            return
+        outgoing.acked = packet.offset if outgoing.acked is None else max(outgoing.acked, packet.offset)
+        outgoing.window = packet.window
+        outgoing.changed.set()
+
+    async def _abort(self, packet: protocol.packet.Packet):
+        self._drop(packet.tid)
+        outgoing = self._outgoing.get(packet.tid)
+        if outgoing is not None:
+            self._fail(outgoing, packet.reason)
@@ -17,6 +17,7 @@ setup(
    packages=['scalar',
              'scalar.protocol',
              'scalar.protocol.encryption',
+             'scalar.protocol.compression',
              'scalar.protocol.packets',
              'scalar.protocol.socket',
              'scalar.server',
@@ -24,5 +25,6 @@ setup(
              'scalar.server.implementations.scalar0',
              'scalar.client',
              'scalar.client.implementations'],
+   package_data={'scalar.protocol.compression': ['dictionaries/*.zdict']},
    install_requires=['cryptography'],
 )
\ No newline at end of file
@@ -41,4 +41,12 @@ assert(datavalued.test1 == datavalued_pack_unpack.test1 and
        datavalued.test2 == datavalued_pack_unpack.test2 and
        datavalued.test3 == datavalued_pack_unpack.test3 and
        datavalued.test4 == datavalued_pack_unpack.test4 and
-       datavalued.test5 == datavalued_pack_unpack.test5)
\ No newline at end of file
+       datavalued.test5 == datavalued_pack_unpack.test5)
+import scalar.protocol.packets.protocol as protocol
+for side in (packet.SERVER, packet.CLIENT):
+    for registered in packet.registered[side].values():
+        if registered.__module__ != protocol.__name__: continue
+        assert 'priority' in registered.__dict__, f"{registered.__name__} doesn't declare its priority"
+assert protocol.CLIENTBOUND_SHeartbeat.priority < protocol.CLIENTBOUND_UserMessage.priority < protocol.CLIENTBOUND_TransferChunk.priority
+# list snapshots and the events that change them share a lane, so they arrive in the order they were sent
+assert protocol.CLIENTBOUND_UserListResponse.priority == protocol.CLIENTBOUND_EventUserJoined.priority == protocol.CLIENTBOUND_EventUserLeft.priority
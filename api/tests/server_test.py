@@ -0,0 +1,257 @@
+import os
+import sys
+import inspect
+
+# import from parent folder
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+import socket
+import asyncio
+import subprocess
+import gzip
+
+from scalar.server.implementations.scalar0.server import Scalar0Server
+from scalar.client.implementations.scalar0 import Scalar0Client
+import scalar.exceptions as exceptions
+import scalar.transfer as transfer
+import scalar.protocol.packets.packet as packet
+import scalar.protocol.packets.protocol as protocol
+
+# server and client events are registered on the class, these are registered once and shared by every test
+throttled = []
+backpressured = []
+failed = []
+kicked = []
+probed = []
+def on_throttle(self, client, state):
+    throttled.append((client._username, state))
+def on_backpressure(self, client, state):
+    backpressured.append((client._username, state))
+def on_exception(self, client, e):
+    failed.append((client, type(e)))
+def on_kick(self, client, reason):
+    kicked.append((client._username, reason))
+def on_heartbeat(self, nonce):
+    probed.append(self._username)
+
+async def until(condition, timeout: float = 10):
+    async with asyncio.timeout(timeout):
+        while not condition():
+            await asyncio.sleep(0.01)
+
+def start_server() -> tuple[Scalar0Server, int, asyncio.Task]:
+    server = Scalar0Server()
+    server.generate_key('dhaes')
+    server.bind('127.0.0.1', 0)
+    server.event("on_throttle")(on_throttle)
+    server.event("on_backpressure")(on_backpressure)
+    server.event("on_exception")(on_exception)
+    server.event("on_kick")(on_kick)
+    for recorded in (throttled, backpressured, failed, kicked, probed):
+        recorded.clear()
+    return server, server._socket._socket.getsockname()[1], asyncio.create_task(server.serve())
+
+async def join(port: int, username: str) -> tuple[Scalar0Client, asyncio.Task]:
+    client = Scalar0Client(username=username)
+    client.generate_key('dhaes')
+    client.event("heartbeat")(on_heartbeat)
+    # the server's probes are under test, the client's own would count as traffic
+    client.set_heartbeat(1000)
+    task = asyncio.create_task(client.serve('127.0.0.1', port))
+    await until(lambda: client._channellist or task.done())
+    return client, task
+
+def served(server: Scalar0Server, username: str):
+    return next(client for client in server.clients() if client._username == username)
+
+async def inbound_throttling():
+    server, port, serving = start_server()
+    server.set_inbound_limits(16 * 1024)
+    alice, alice_task = await join(port, "alice")
+    bob, bob_task = await join(port, "bob")
+    # what alice makes the server send bob counts against her until it is written out
+    await alice.send_message(alice._channellist[0], "x" * 32 * 1024)
+    await until(lambda: ("alice", False) in throttled)
+    assert throttled == [("alice", True), ("alice", False)]
+    assert served(server, "alice").inbound_debt() == 0
+    # under the limit nothing is held back
+    await alice.send_message(alice._channellist[0], "small")
+    await until(lambda: served(server, "bob").queued_bytes() == 0)
+    assert len(throttled) == 2
+    for client in (alice, bob):
+        client.close()
+    serving.cancel()
+asyncio.run(inbound_throttling())
+
+async def write_backpressure():
+    server, port, serving = start_server()
+    server.set_write_buffer_limits(high=64 * 1024)
+    alice, alice_task = await join(port, "alice")
+    bob, bob_task = await join(port, "bob")
+    # bob stops reading, what the server queues for bob grows once the kernel buffers are full
+    bob._socket._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    bob_task.cancel()
+    # random, so compression doesn't shrink it to nothing
+    payload = os.urandom(16 * 1024).hex()
+    async with asyncio.timeout(30):
+        while ("bob", True) not in backpressured:
+            await alice.send_message(alice._channellist[0], payload)
+            await asyncio.sleep(0)
+    assert served(server, "bob").queued_bytes() > 64 * 1024
+    # reading again drains the queue below the low watermark
+    async def read():
+        async for packet in bob.packets():
+            pass
+    reading = asyncio.create_task(read())
+    await until(lambda: ("bob", False) in backpressured)
+    assert [state for username, state in backpressured if username == "bob"] == [True, False]
+    for client in (alice, bob):
+        client.close()
+    reading.cancel()
+    serving.cancel()
+asyncio.run(write_backpressure())
+
+async def connections_released():
+    server, port, serving = start_server()
+    alice, alice_task = await join(port, "alice")
+    bob, bob_task = await join(port, "bob")
+    assert server.metrics()["connections"] == 2
+    assert server.metrics()["connection_tasks"] > 0
+    # kicked from the outside, the connection's tasks are cancelled and its finalizers run
+    await served(server, "bob").kick("testing")
+    await until(lambda: bob_task.done())
+    assert type(bob_task.exception()) is exceptions.ClientKicked
+    await until(lambda: server.metrics()["connections"] == 1)
+    # gone on its own, the reader notices and tears down the same way
+    alice.close()
+    await until(lambda: server.metrics()["connections"] == 0)
+    await until(lambda: server.metrics()["connection_tasks"] == 0)
+    assert server.metrics()["clients"] == 0
+    assert not server._handshake_tasks or all(task.done() for task in server._handshake_tasks)
+    serving.cancel()
+asyncio.run(connections_released())
+
+async def handshake_failures():
+    server, port, serving = start_server()
+    server._handshake_timeout = 0.3
+    server._max_handshakes = 2
+    async def connect(data: bytes) -> asyncio.StreamReader:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(data)
+        return reader
+    # garbage for a first frame, an unknown packet, and a peer that never says anything
+    readers = [await connect(data) for data in (
+        b"\x04\x00\xff\xff\xff\xff",
+        b"\x01\x00\x00",
+        len(gzip.compress(b"\xff\xff")).to_bytes(2, 'little') + gzip.compress(b"\xff\xff"),
+        b"",
+    )]
+    # every one of them is hung up on, the silent one once the deadline passes
+    async with asyncio.timeout(5):
+        for reader in readers:
+            assert await reader.read() == b""
+    # only what isn't a bad frame or a timeout is reported
+    assert failed == [(None, exceptions.PacketUnknown)]
+    await until(lambda: not server._handshake_tasks)
+    assert server._handshakes._value == server._max_handshakes
+    # the cap held no slot back, a real client still gets in
+    alice, alice_task = await join(port, "alice")
+    assert alice._channellist
+    alice.close()
+    serving.cancel()
+asyncio.run(handshake_failures())
+
+async def shared_partials():
+    server = Scalar0Server()
+    server.set_transfers(resume_window=0.05)
+    budget = server._transfer_budget
+    async def send(sent):
+        pass
+    async def begin(receiver: transfer.Transfers, tid: int):
+        await receiver._begin(protocol.TRANSFER[packet.SERVER]["begin"](tid=tid, name="", size=1000, digest=""))
+    def receiver(partials: dict) -> transfer.Transfers:
+        return transfer.Transfers(packet.CLIENT, send, send, partials, budget=budget)
+    # two connections logged in with the same key, the first one leaving doesn't park what the second is receiving
+    first = server._claim_partials("key")
+    second = server._claim_partials("key")
+    assert first is second
+    staying = receiver(second)
+    await begin(staying, 1)
+    assert budget.used == 1000
+    server._park_partials("key")
+    await asyncio.sleep(0.2)
+    assert budget.used == 1000 and 1 in second
+    staying._drop(1)
+    assert budget.used == 0
+    # the last one leaving parks them, expiry releases them exactly once
+    await begin(staying, 2)
+    server._park_partials("key")
+    await until(lambda: budget.used == 0)
+    staying._drop(2)
+    assert budget.used == 0
+    assert not server._transfer_partials and not server._transfer_holders
+asyncio.run(shared_partials())
+
+async def heartbeats():
+    server, port, serving = start_server()
+    server.set_heartbeat(0.2, 2)
+    alice, alice_task = await join(port, "alice")
+    bob, bob_task = await join(port, "bob")
+    # alice keeps talking, the server hears from her often enough to never ask
+    for i in range(10):
+        await alice.send_message(alice._channellist[0], str(i))
+        await asyncio.sleep(0.05)
+    assert "alice" not in probed
+    # bob only answers, each probe is counted
+    await until(lambda: probed.count("bob") >= 2)
+    assert server.metrics()["heartbeats_sent"] >= 2 and server.metrics()["heartbeat_rate"] > 0
+    assert not kicked
+    # probes falling due together share one task
+    server._queue_probe(served(server, "alice"))
+    server._queue_probe(served(server, "bob"))
+    assert len(server._probe_tasks) == 1
+    # bob stops reading, after two unanswered probes the third is a kick
+    bob_task.cancel()
+    await until(lambda: kicked)
+    assert kicked == [("bob", "Heartbeat stopped (missed 2 heartbeat attempts)")]
+    await until(lambda: server.metrics()["connections"] == 1)
+    alice.close()
+    serving.cancel()
+asyncio.run(heartbeats())
+
+async def workers():
+    # forks, so it gets a process of its own, told to pick any port and to say which
+    process = subprocess.Popen([sys.executable, "-c", f"""
+import sys
+sys.path.insert(0, {parentdir!r})
+from scalar.server.implementations.scalar0.server import Scalar0Server
+server = Scalar0Server()
+server.generate_key('dhaes')
+server.bind('127.0.0.1', 0)
+print(server._socket._socket.getsockname()[1], flush=True)
+server.run(workers=2)
+"""], stdout=subprocess.PIPE, text=True)
+    try:
+        port = int(process.stdout.readline())
+        received = {}
+        def on_message(self, message):
+            received.setdefault(self._username, []).append(message.content)
+        clients = []
+        for i in range(6):
+            client, task = await join(port, f"worker{i}")
+            assert client._channellist, "worker didn't take the connection"
+            client.event("on_message")(on_message)
+            clients.append(client)
+        # both workers listen on the one port, and each hears about users the other has
+        await until(lambda: all(len(client._userlist) == len(clients) for client in clients))
+        await clients[0].send_message(clients[0]._channellist[0], "to every worker")
+        await until(lambda: len(received) == len(clients))
+        assert all(messages == ["to every worker"] for messages in received.values())
+        for client in clients:
+            client.close()
+    finally:
+        process.terminate()
+        process.wait()
+asyncio.run(workers())
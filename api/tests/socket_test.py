@@ -0,0 +1,509 @@
+import os
+import sys
+import inspect
+
+# import from parent folder
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir) 
+
+import socket
+import gzip
+import tempfile
+import asyncio
+
+from scalar.protocol.socket.protosocket import ProtoSocket
+from scalar.protocol.socket.multiplex import Multiplexer
+import scalar.protocol.socket.basesocket as basesocket
+from scalar.protocol.socket.constants import *
+import scalar.protocol.packets.protocol as protocol
+import scalar.protocol.encryption as encryption
+import scalar.protocol.compression as compression
+import scalar.exceptions as exceptions
+
+def socket_pair():
+    a, b = socket.socketpair()
+    client = ProtoSocket.fromSocket('a', 0, a)
+    server = ProtoSocket.fromSocket('b', 0, b)
+    server._bound = True # server side decodes SERVERBOUND packets
+    return client, server
+
+async def many_frames():
+    client, server = socket_pair()
+    messages = [f"message {i}" for i in range(1000)] + ["x" * 200000, os.urandom(30000).hex()]
+    async def sender():
+        for message in messages:
+            assert await client.send_packet(protocol.SERVERBOUND_SendMessage(channel=1, message=message)) == SOCKET_SUCCESS
+    send_task = asyncio.create_task(sender())
+    for message in messages:
+        stat, packet = await server.recv_packet()
+        assert stat == SOCKET_SUCCESS
+        assert type(packet) is protocol.SERVERBOUND_SendMessage
+        assert packet.message == message
+    await send_task
+    client.close()
+    stat, packet = await server.recv_packet()
+    assert stat == SOCKET_BROKENP and packet is None
+asyncio.run(many_frames())
+
+async def partial_frame_timeout():
+    client, server = socket_pair()
+    server.settimeout(0.1)
+    client._socket.send(b'\x10\x00half')
+    stat, frame = await server.recv_frame()
+    assert stat == SOCKET_TIMEOUT
+    # bytes read before the timeout are kept, so the stream stays in sync
+    client._socket.send(b'-of-the-frame')
+    stat, frame = await server.recv_frame()
+    assert stat == SOCKET_SUCCESS and bytes(frame) == b'half-of-the-fram'
+asyncio.run(partial_frame_timeout())
+
+async def large_frames():
+    client, server = socket_pair()
+    message = os.urandom(100000).hex()
+    try:
+        await client.send_packet(protocol.SERVERBOUND_SendMessage(channel=1, message=message))
+        assert False, "frame must not fit a 2-byte length prefix"
+    except exceptions.FrameTooLarge:
+        pass
+    client.use_extensions(client.accept_extensions([EXTENSION_FRAME32]))
+    server.use_extensions([EXTENSION_FRAME32])
+    send_task = asyncio.create_task(client.send_packet(protocol.SERVERBOUND_SendMessage(channel=1, message=message)))
+    stat, packet = await server.recv_packet()
+    assert stat == SOCKET_SUCCESS and packet.message == message
+    assert await send_task == SOCKET_SUCCESS
+    # receiver refuses frames over its limit before reading them in
+    server.set_max_frame_size(1024)
+    client._socket.send(int.to_bytes(1 << 30, 4, 'little'))
+    try:
+        await server.recv_packet()
+        assert False, "oversized frame must be refused"
+    except exceptions.FrameTooLarge:
+        pass
+    assert len(server._recv_buffer) == RECV_BUFFER_SIZE
+asyncio.run(large_frames())
+
+async def receive_buffer_shrinks():
+    client, server = socket_pair()
+    client.use_extensions([EXTENSION_FRAME32])
+    server.use_extensions([EXTENSION_FRAME32])
+    big = os.urandom(RECV_BUFFER_SIZE * 2)
+    send_task = asyncio.create_task(client.send_frame(big))
+    stat, frame = await server.recv_frame()
+    assert stat == SOCKET_SUCCESS
+    await send_task
+    # one big frame doesn't pin a big buffer for the rest of the connection
+    assert len(server._recv_buffer) == RECV_BUFFER_SIZE
+    for i in range(3):
+        assert await client.send_frame(b"small") == SOCKET_SUCCESS
+        stat, small = await server.recv_frame()
+        assert stat == SOCKET_SUCCESS and bytes(small) == b"small"
+    assert len(server._recv_buffer) == RECV_BUFFER_SIZE
+    # the frame handed out before still reads the same
+    assert bytes(frame) == big
+asyncio.run(receive_buffer_shrinks())
+
+async def decompression_bomb():
+    client, server = socket_pair()
+    client.use_extensions([EXTENSION_FRAME32])
+    server.use_extensions([EXTENSION_FRAME32])
+    # 64MiB of zeroes packs into a ~64KiB frame
+    bomb = gzip.compress(bytes(64 * 1024 * 1024))
+    send_task = asyncio.create_task(client.send_frame(bomb))
+    try:
+        await server.recv_packet()
+        assert False, "bomb must not be inflated"
+    except exceptions.DecompressionLimitExceeded:
+        pass
+    await send_task
+    server.set_decompression_limits(1024, 1)
+    send_task = asyncio.create_task(client.send_frame(gzip.compress(bytes(4096))))
+    try:
+        await server.recv_packet()
+        assert False, "frame over the size limit must not be inflated"
+    except exceptions.DecompressionLimitExceeded:
+        pass
+    await send_task
+asyncio.run(decompression_bomb())
+
+async def corrupt_compression():
+    client, server = socket_pair()
+    for frame in (gzip.compress(b"cut short")[:-6], b"\x1f\x8b not gzip at all", b""):
+        send_task = asyncio.create_task(client.send_frame(frame))
+        try:
+            await server.recv_packet()
+            assert False, "corrupt frame was unpacked"
+        except exceptions.FrameMalformed:
+            pass
+        await send_task
+    # the shared stream context fails the same way
+    client, server = socket_pair()
+    client.use_extensions([EXTENSION_COMPRESS + COMPRESSION_STREAM])
+    server.use_extensions([EXTENSION_COMPRESS + COMPRESSION_STREAM])
+    send_task = asyncio.create_task(client.send_frame(bytes([PAYLOAD_COMPRESSED]) + b"\xff" * 64))
+    try:
+        await server.recv_packet()
+        assert False, "corrupt stream frame was unpacked"
+    except exceptions.FrameMalformed:
+        pass
+    await send_task
+asyncio.run(corrupt_compression())
+
+async def negotiated_compression():
+    client, server = socket_pair()
+    client.set_compression([COMPRESSION_GZIP, COMPRESSION_ZLIB], 64)
+    extensions = server.accept_extensions(client.offer_extensions())
+    assert EXTENSION_COMPRESS + COMPRESSION_GZIP in extensions
+    client.use_extensions(extensions)
+    server.use_extensions(extensions)
+    for message in ["hi", "x" * 4096]:
+        send_task = asyncio.create_task(client.send_packet(protocol.SERVERBOUND_SendMessage(channel=1, message=message)))
+        stat, packet = await server.recv_packet()
+        assert stat == SOCKET_SUCCESS and packet.message == message
+        await send_task
+    assert client._compress(b"hi")[0] == 0
+    assert client._compress(b"x" * 4096)[0] == PAYLOAD_COMPRESSED
+asyncio.run(negotiated_compression())
+
+async def streaming_compression():
+    client, server = socket_pair()
+    client.set_compression([COMPRESSION_STREAM] + COMPRESSIONS, window_bits=10, mem_level=4)
+    server.set_compression([COMPRESSION_STREAM] + COMPRESSIONS)
+    extensions = server.accept_extensions(client.offer_extensions())
+    assert EXTENSION_COMPRESS + COMPRESSION_STREAM in extensions
+    client.use_extensions(extensions)
+    server.use_extensions(extensions)
+    sizes = []
+    raw = protocol.SERVERBOUND_SendMessage(channel=1, message="hello everyone in channel one").pack()
+    for _ in range(3):
+        compressed = client._compress(raw)
+        sizes.append(len(compressed))
+        assert server._decompress(compressed) == raw
+    # repeats are mostly back-references into the shared window
+    assert sizes[1] < sizes[0] // 2
+    send_tasks = [asyncio.create_task(client.send_packet(protocol.SERVERBOUND_SendMessage(channel=1, message=str(i)))) for i in range(50)]
+    for i in range(50):
+        stat, packet = await server.recv_packet()
+        assert stat == SOCKET_SUCCESS and packet.message == str(i)
+    await asyncio.gather(*send_tasks)
+asyncio.run(streaming_compression())
+
+async def preset_dictionary():
+    client, server = socket_pair()
+    client.set_dictionaries(["no-such-dictionary", "scalar0-1"])
+    extensions = server.accept_extensions(client.offer_extensions())
+    assert EXTENSION_ZDICT + "scalar0-1" in extensions
+    client.use_extensions(extensions)
+    server.use_extensions(extensions)
+    raw = protocol.SERVERBOUND_SendMessage(channel=1, message="hello everyone, how are you doing today").pack()
+    compressed = client._compress(raw)
+    assert compressed[0] == PAYLOAD_COMPRESSED and len(compressed) < len(raw)
+    assert server._decompress(compressed) == raw
+    send_task = asyncio.create_task(client.send_packet(protocol.SERVERBOUND_SendMessage(channel=1, message="x" * 4096)))
+    stat, packet = await server.recv_packet()
+    assert stat == SOCKET_SUCCESS and packet.message == "x" * 4096
+    await send_task
+asyncio.run(preset_dictionary())
+
+async def coalesced_frames():
+    client, server = socket_pair()
+    extensions = server.accept_extensions(client.offer_extensions())
+    assert EXTENSION_BATCH in extensions
+    client.use_extensions(extensions)
+    server.use_extensions(extensions)
+    packets = [protocol.SERVERBOUND_SendMessage(channel=1, message=str(i)).pack() for i in range(10)]
+    assert await client.send_batch(packets) == SOCKET_SUCCESS
+    client.set_coalescing(0.01)
+    for i in range(10, 20):
+        assert await client.send_packet(protocol.SERVERBOUND_SendMessage(channel=1, message=str(i))) == SOCKET_SUCCESS
+    assert await client.flush() == SOCKET_SUCCESS
+    for i in range(20):
+        stat, packet = await server.recv_packet()
+        assert stat == SOCKET_SUCCESS and packet.message == str(i)
+        if i % 10 == 0:
+            # each burst arrived as one frame
+            assert len(server._unbatched) == 9
+    frame = server.encryption.encrypt(bytes((PAYLOAD_BATCH,)) + int.to_bytes(100, 4, 'little') + packets[0])
+    send_task = asyncio.create_task(client.send_frame(frame))
+    try:
+        await server.recv_packet()
+        assert False, "batch that overruns its frame must be refused"
+    except exceptions.FrameMalformed:
+        pass
+    await send_task
+asyncio.run(coalesced_frames())
+
+async def packet_iterator():
+    client, server = socket_pair()
+    for i in range(5):
+        await client.send_packet(protocol.SERVERBOUND_SendMessage(channel=1, message=str(i)))
+    client.close()
+    received = []
+    try:
+        async for packet in server.packets():
+            received.append(packet.message)
+        assert False, "iteration ends with the connection"
+    except exceptions.SocketBroken:
+        pass
+    assert received == [str(i) for i in range(5)]
+asyncio.run(packet_iterator())
+
+async def shared_payloads():
+    pairs = [socket_pair() for _ in range(3)]
+    for client, server in pairs:
+        extensions = client.accept_extensions(server.offer_extensions())
+        client.use_extensions(extensions)
+        server.use_extensions(extensions)
+    stream_client, stream_server = socket_pair()
+    stream_client.set_compression([COMPRESSION_STREAM])
+    stream_client.use_extensions(stream_client.accept_extensions([EXTENSION_COMPRESS + COMPRESSION_STREAM]))
+    stream_server.use_extensions(stream_client.extensions)
+    pairs.append((stream_client, stream_server))
+    packet = protocol.CLIENTBOUND_ServerMessage(mid=1, channel=1, message="y" * 1000)
+    for client, server in pairs:
+        send_task = asyncio.create_task(server.send_packet(packet))
+        stat, received = await client.recv_packet()
+        assert stat == SOCKET_SUCCESS and received.message == packet.message
+        await send_task
+    # packed and compressed once for every socket that compresses alike, streams compress their own
+    assert len(packet._wire) == 1
+asyncio.run(shared_payloads())
+
+async def multiplexed_streams():
+    client, server = socket_pair()
+    client_mux, server_mux = Multiplexer(client), Multiplexer(server)
+    client_mux.start()
+    server_mux.start()
+    first, second = client_mux.open_stream(), client_mux.open_stream()
+    # stream ids have to show up in order, the server takes a lower one for a stream long gone
+    assert await first.send_packet(protocol.SERVERBOUND_SendMessage(channel=1, message="first")) == SOCKET_SUCCESS
+    assert await second.send_packet(protocol.SERVERBOUND_SendMessage(channel=2, message="second")) == SOCKET_SUCCESS
+    accepted = {}
+    for _ in range(2):
+        stream = await server_mux.accept()
+        stat, packet = await stream.recv_packet()
+        assert stat == SOCKET_SUCCESS and packet.channel == stream.stream_id + 1
+        accepted[stream.stream_id] = stream
+    # closing one session leaves the others and the connection alone
+    first.close()
+    stat, packet = await accepted[0].recv_packet()
+    assert stat == SOCKET_BROKENP
+    assert await accepted[1].send_packet(protocol.CLIENTBOUND_Kick(reason="bye")) == SOCKET_SUCCESS
+    stat, packet = await second.recv_packet()
+    assert stat == SOCKET_SUCCESS and packet.reason == "bye"
+    # the connection goes away with its last session
+    second.close()
+    assert await server_mux.accept() is None
+asyncio.run(multiplexed_streams())
+
+CLIENT_KEYS = encryption.DHKeypair.generate().save()
+SERVER_KEYS = encryption.DHKeypair.generate().save()
+
+def encrypted_pair(counter_nonces: bool):
+    # the same long-term keys every time, like a client reconnecting to the same server
+    client, server = socket_pair()
+    offered = client.offer_extensions() if counter_nonces else [EXTENSION_FRAME32]
+    extensions = server.accept_extensions(offered)
+    client.use_extensions(extensions)
+    server.use_extensions(extensions)
+    client_encryption = encryption.DHAESEncryption(encryption.DHKeypair.load(CLIENT_KEYS))
+    server_encryption = encryption.DHAESEncryption(encryption.DHKeypair.load(SERVER_KEYS))
+    client_encryption.exchange(server_encryption.public_key())
+    server_encryption.exchange(client_encryption.public_key())
+    client.set_encryption(client_encryption)
+    server.set_encryption(server_encryption)
+    return client, server
+
+async def counter_nonces():
+    sizes = {}
+    for counter_nonces in (False, True):
+        sizes[counter_nonces] = len(encrypted_pair(counter_nonces)[0].encryption.encrypt(b""))
+        client, server = encrypted_pair(counter_nonces)
+        for message in ["one", "two", "x" * 4096]:
+            send_task = asyncio.create_task(client.send_packet(protocol.SERVERBOUND_SendMessage(channel=1, message=message)))
+            stat, packet = await server.recv_packet()
+            assert stat == SOCKET_SUCCESS and packet.message == message
+            await send_task
+            send_task = asyncio.create_task(server.send_packet(protocol.CLIENTBOUND_Kick(reason=message)))
+            stat, packet = await client.recv_packet()
+            assert stat == SOCKET_SUCCESS and packet.reason == message
+            await send_task
+    # no iv on the wire once both sides count
+    assert sizes[False] - sizes[True] == 12
+    # counters start over on every connection, so the key must not repeat with them
+    first, second = encrypted_pair(True)[0], encrypted_pair(True)[0]
+    assert first.nonce_salt != second.nonce_salt
+    assert first.encryption.encrypt(bytes(64)) != second.encryption.encrypt(bytes(64))
+    # nor a frame refused for its size
+    client, server = encrypted_pair(True)
+    client._header_size = server._header_size = 2
+    try:
+        await client.send_packet(protocol.SERVERBOUND_SendMessage(channel=1, message=os.urandom(70000).hex()))
+        assert False, "oversized frame was sent"
+    except exceptions.FrameTooLarge:
+        pass
+    send_task = asyncio.create_task(client.send_packet(protocol.SERVERBOUND_SendMessage(channel=1, message="after")))
+    stat, packet = await server.recv_packet()
+    assert stat == SOCKET_SUCCESS and packet.message == "after"
+    await send_task
+    # a multiplexed frame that never goes out must not use up a nonce
+    client, server = encrypted_pair(True)
+    client_mux, server_mux = Multiplexer(client), Multiplexer(server)
+    client_mux.start()
+    server_mux.start()
+    stream = client_mux.open_stream()
+    await client._send_lock.acquire()
+    dropped = asyncio.create_task(stream.send_packet(protocol.SERVERBOUND_SendMessage(channel=1, message="dropped")))
+    await asyncio.sleep(0)
+    dropped.cancel()
+    client._send_lock.release()
+    assert await stream.send_packet(protocol.SERVERBOUND_SendMessage(channel=1, message="kept")) == SOCKET_SUCCESS
+    stat, packet = await (await server_mux.accept()).recv_packet()
+    assert stat == SOCKET_SUCCESS and packet.message == "kept"
+    client_mux.close()
+asyncio.run(counter_nonces())
+
+async def stream_limits():
+    client, server = encrypted_pair(True)
+    client_mux, server_mux = Multiplexer(client), Multiplexer(server)
+    server_mux.max_streams = 2
+    client_mux.start()
+    server_mux.start()
+    streams = [client_mux.open_stream() for _ in range(3)]
+    for stream in streams:
+        assert await stream.send_packet(protocol.SERVERBOUND_SendMessage(channel=stream.stream_id, message="hi")) == SOCKET_SUCCESS
+    accepted = [await server_mux.accept() for _ in range(2)]
+    # one stream over the limit is closed right away
+    stat, packet = await streams[2].recv_packet()
+    assert stat == SOCKET_BROKENP
+    assert server_mux.streams() == 2
+    # a forged frame is dropped without taking the connection or its streams along
+    assert await client.send_frame(os.urandom(64)) == SOCKET_SUCCESS
+    # nor does a closed stream come back as a new session
+    accepted[0].close()
+    stat, packet = await streams[0].recv_packet()
+    assert stat == SOCKET_BROKENP
+    assert await client_mux._send(0, protocol.SERVERBOUND_SendMessage(channel=0, message="again").pack()) == SOCKET_SUCCESS
+    assert await streams[1].send_packet(protocol.SERVERBOUND_SendMessage(channel=1, message="still here")) == SOCKET_SUCCESS
+    for message in ("hi", "still here"):
+        stat, packet = await accepted[1].recv_packet()
+        assert stat == SOCKET_SUCCESS and packet.message == message
+    assert server_mux.streams() == 1 and server_mux._incoming.empty()
+    client_mux.close()
+asyncio.run(stream_limits())
+
+async def closing_coalesced():
+    client, server = socket_pair()
+    extensions = server.accept_extensions(client.offer_extensions())
+    client.use_extensions(extensions)
+    server.use_extensions(extensions)
+    client.set_coalescing(10)
+    for i in range(3):
+        assert await client.send_packet(protocol.SERVERBOUND_SendMessage(channel=1, message=str(i))) == SOCKET_SUCCESS
+    assert client.pending()
+    # closing gracefully sends what was waiting for company first
+    await client.aclose()
+    for i in range(3):
+        stat, packet = await server.recv_packet()
+        assert stat == SOCKET_SUCCESS and packet.message == str(i)
+    client, server = socket_pair()
+    client.set_coalescing(10)
+    await client.send_packet(protocol.SERVERBOUND_SendMessage(channel=1, message="dropped"))
+    client.close()
+    assert not client.pending() and client._coalesce_handle is None
+asyncio.run(closing_coalesced())
+
+def dictionary_order():
+    # newest first by version number, not by string order
+    path = tempfile.mkdtemp()
+    for name in ("scalar0-9", "scalar0-10", "scalar0-2"):
+        with open(os.path.join(path, name + ".zdict"), "wb") as f:
+            f.write(name.encode())
+    assert list(compression.load_dictionaries(path)) == ["scalar0-10", "scalar0-9", "scalar0-2"]
+dictionary_order()
+
+def stalled_listener() -> tuple[socket.socket, int, list[socket.socket]]:
+    # a full accept queue drops further SYNs, connecting to it hangs until someone gives up
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(0)
+    port = listener.getsockname()[1]
+    fillers = []
+    for i in range(4):
+        filler = socket.socket()
+        filler.setblocking(False)
+        filler.connect_ex(("127.0.0.1", port))
+        fillers.append(filler)
+    return listener, port, fillers
+
+async def connect_racing():
+    listener, port, fillers = stalled_listener()
+    good = socket.socket()
+    good.bind(("127.0.0.1", 0))
+    good.listen(1)
+    refused = socket.socket()
+    refused.bind(("127.0.0.1", 0))
+    refused_port = refused.getsockname()[1]
+    refused.close()
+    await asyncio.sleep(0.1)
+    # a refused address is skipped right away, a stalled one after the delay
+    sock = await basesocket._race_connections([(socket.AF_INET, ("127.0.0.1", refused_port)), (socket.AF_INET, good.getsockname())], 5)
+    assert sock.getpeername() == good.getsockname()
+    sock.close()
+    started = asyncio.get_running_loop().time()
+    sock = await basesocket._race_connections([(socket.AF_INET, ("127.0.0.1", port)), (socket.AF_INET, good.getsockname())], 0.05)
+    assert sock.getpeername() == good.getsockname()
+    assert asyncio.get_running_loop().time() - started < 1
+    sock.close()
+    try:
+        await basesocket._race_connections([(socket.AF_INET, ("127.0.0.1", refused_port))], 0.05)
+        assert False, "connected to a closed port"
+    except ConnectionRefusedError:
+        pass
+    # the deadline covers the whole race and is reported as a timeout, not a cancellation
+    client = ProtoSocket(host="127.0.0.1", port=port)
+    started = asyncio.get_running_loop().time()
+    try:
+        await client.connect(timeout=0.2)
+        assert False, "connected to a stalled listener"
+    except exceptions.SocketTimedOut:
+        pass
+    assert asyncio.get_running_loop().time() - started < 1
+    assert asyncio.current_task().cancelling() == 0
+    assert client._socket is None
+    for sock in fillers + [listener, good]:
+        sock.close()
+asyncio.run(connect_racing())
+
+async def unix_sockets():
+    path = os.path.join(tempfile.mkdtemp(), "scalar.sock")
+    listener = ProtoSocket(host=UNIX_SCHEME + path, port=0)
+    listener.bind(8)
+    client = ProtoSocket(host=UNIX_SCHEME + path, port=0)
+    await client.connect(timeout=5)
+    addr, server = await listener.accept()
+    assert await client.send_packet(protocol.SERVERBOUND_SendMessage(channel=1, message="over a unix socket")) == SOCKET_SUCCESS
+    stat, packet = await server.recv_packet()
+    assert stat == SOCKET_SUCCESS and packet.message == "over a unix socket"
+    for sock in (client, server, listener):
+        sock.close()
+    # closing the listener takes its file along
+    assert not os.path.exists(path)
+    # the socket file a crashed run left behind is replaced
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(path)
+    stale.close()
+    listener = ProtoSocket(host=UNIX_SCHEME + path, port=0)
+    listener.bind(8)
+    listener.close()
+    # anything else at the path is left alone
+    with open(path, "w") as f:
+        f.write("not a socket")
+    try:
+        ProtoSocket(host=UNIX_SCHEME + path, port=0).bind(8)
+        assert False, "bound over a regular file"
+    except FileExistsError:
+        pass
+    with open(path) as f:
+        assert f.read() == "not a socket"
+asyncio.run(unix_sockets())
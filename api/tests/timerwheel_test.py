@@ -0,0 +1,33 @@
+import os
+import sys
+import inspect
+
+# import from parent folder
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir) 
+
+import asyncio
+import random
+
+import scalar.timerwheel as timerwheel
+
+async def fire_in_order():
+    loop = asyncio.get_running_loop()
+    # fine resolution so every level of the wheel gets used within a second
+    wheel = timerwheel.TimerWheel(loop, resolution=0.0001)
+    started = loop.time()
+    fired = []
+    delays = [random.uniform(0, 1) for _ in range(2000)] + [0, 0.0064, 0.4096]
+    timers = [wheel.schedule(delay, lambda delay=delay: fired.append((delay, loop.time() - started))) for delay in delays]
+    cancelled = set(timers[:300])
+    for timer in cancelled:
+        timer.cancel()
+    assert len(wheel) == len(delays) - 300
+    await asyncio.sleep(1.2)
+    assert len(wheel) == 0
+    assert len(fired) == len(delays) - 300
+    # never earlier than the tick the deadline falls in
+    assert all(at >= delay - 0.0001 for delay, at in fired)
+    assert not any(timer.expired for timer in cancelled)
+asyncio.run(fire_in_order())
@@ -0,0 +1,128 @@
+import os
+import sys
+import inspect
+
+# import from parent folder
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0, parentdir)
+
+import asyncio
+
+import scalar.transfer as transfer
+import scalar.exceptions as exceptions
+import scalar.protocol.packets.packet as packet
+
+def link(partials: dict|None = None, **receiver):
+    # a client and a server side joined by queues, every packet goes over the wire format
+    delivered = []
+    queues = {packet.SERVER: asyncio.Queue(), packet.CLIENT: asyncio.Queue()}
+    async def deliver(tid, name, data):
+        delivered.append((tid, name, data))
+    async def to(side, sent):
+        queues[side].put_nowait(packet.Packet.unpack(side, sent.pack()))
+    client = transfer.Transfers(packet.SERVER, lambda sent: to(packet.SERVER, sent), deliver)
+    server = transfer.Transfers(packet.CLIENT, lambda sent: to(packet.CLIENT, sent), deliver, partials, **receiver)
+    async def pump(side, end):
+        while True:
+            await end.receive(await queues[side].get())
+    tasks = [asyncio.create_task(pump(packet.SERVER, server)), asyncio.create_task(pump(packet.CLIENT, client))]
+    return client, server, queues, delivered, tasks
+
+async def whole_transfer():
+    client, server, queues, delivered, tasks = link()
+    data = os.urandom(transfer.WINDOW * 3 + 123)
+    tid = await client.send(data, "export")
+    assert delivered == [(tid, "export", data)]
+    assert server._partials == {}
+    # nothing sent at all still makes a transfer
+    tid = await client.send(b"", "empty")
+    assert delivered[-1] == (tid, "empty", b"")
+    for task in tasks: task.cancel()
+asyncio.run(whole_transfer())
+
+async def resumed_transfer():
+    partials = {}
+    client, server, queues, delivered, tasks = link(partials)
+    data = os.urandom(transfer.WINDOW * 2)
+    sending = asyncio.create_task(client.send(data, "attachment", tid=7))
+    while 7 not in partials or len(partials[7].data) < transfer.WINDOW:
+        await asyncio.sleep(0)
+    # the connection drops halfway through
+    for task in tasks: task.cancel()
+    client.close()
+    try:
+        await sending
+        assert False, "sender outlived its connection"
+    except exceptions.TransferAborted:
+        pass
+    received = len(partials[7].data)
+    assert 0 < received < len(data)
+    client, server, queues, delivered, tasks = link(partials)
+    chunks = []
+    original = server.receive
+    async def counting(received_packet):
+        if type(received_packet).__name__.endswith("TransferChunk"):
+            chunks.append(received_packet.offset)
+        await original(received_packet)
+    server.receive = counting
+    assert await client.send(data, "attachment", tid=7) == 7
+    assert delivered == [(7, "attachment", data)]
+    assert chunks[0] == received
+    for task in tasks: task.cancel()
+asyncio.run(resumed_transfer())
+
+async def refused_transfer():
+    client, server, queues, delivered, tasks = link()
+    try:
+        await client.send(b"x" * (transfer.MAX_TRANSFER_SIZE + 1))
+        assert False, "oversized transfer was accepted"
+    except exceptions.TransferAborted:
+        pass
+    # a sender that ignores the window is cut off
+    await server._begin(packet.Packet.unpack(packet.SERVER, client._packets["begin"](tid=1, size=transfer.WINDOW * 4, digest="").pack()))
+    await server._chunk(client._packets["chunk"](tid=1, offset=0, data=bytes(transfer.WINDOW + 1)))
+    assert 1 not in server._partials
+    assert not delivered
+    for task in tasks: task.cancel()
+asyncio.run(refused_transfer())
+
+async def limited_transfers():
+    client, server, queues, delivered, tasks = link(accept=False)
+    try:
+        await client.send(b"not wanted")
+        assert False, "transfer was accepted with transfers turned off"
+    except exceptions.TransferAborted:
+        pass
+    for task in tasks: task.cancel()
+    # every connection draws on one budget, unfinished transfers keep what they reserved
+    budget = transfer.Budget(transfer.WINDOW * 3)
+    partials = {}
+    client, server, queues, delivered, tasks = link(partials, budget=budget)
+    data = os.urandom(transfer.WINDOW * 2)
+    sending = asyncio.create_task(client.send(data, tid=1))
+    while 1 not in partials or not partials[1].data:
+        await asyncio.sleep(0)
+    for task in tasks: task.cancel()
+    client.close()
+    try:
+        await sending
+    except exceptions.TransferAborted:
+        pass
+    assert budget.used == len(data)
+    client, server, queues, delivered, tasks = link({}, budget=budget)
+    try:
+        await client.send(data, tid=2)
+        assert False, "transfer went over the budget"
+    except exceptions.TransferAborted:
+        pass
+    assert budget.used == len(data)
+    await client.send(os.urandom(transfer.WINDOW), tid=3)
+    assert budget.used == len(data)
+    for task in tasks: task.cancel()
+    # picking the unfinished one up again doesn't reserve twice
+    client, server, queues, delivered, tasks = link(partials, budget=budget)
+    await client.send(data, tid=1)
+    assert delivered[-1][2] == data and budget.used == 0
+    for task in tasks: task.cancel()
+asyncio.run(limited_transfers())